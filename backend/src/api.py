@@ -1,18 +1,35 @@
 import os
 import logging
 import logging.config
-from flask import Flask, request, jsonify, abort
+from flask import (Flask, Response, request, jsonify, abort,
+                   stream_with_context)
 from sqlalchemy import exc
 import json
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-from .database.models import (Drink,
+from .database.models import (Drink, commit_changes, drink_changes_since,
+                              drinks_after, existing_titles, get_drink_count,
+                              iter_drinks, menu_change_listeners, title_taken,
                               setup_db, db_drop_and_create_all, db_rollback)
-from .auth.auth import AuthError, requires_auth
+from .database.menu import menu_cache
+from .database.coalescer import WriteCoalescer
+from .auth.auth import (AuthError, check_permissions, requires_auth,
+                        auth_metrics, rejected_tokens, token_cache,
+                        trusted_issuers)
+from .events import MenuEventBroker, TooManySubscribersError
+from .ratelimit import (RateLimiter, RateLimitError, bucket_store_from_env,
+                        limit_by_client, limit_by_subject)
 
 app = Flask(__name__)
 setup_db(app)
-CORS(app)
+CORS(app, expose_headers=['X-Total-Count', 'ETag'])
+
+# the number of reverse proxies in front of the app, their X-Forwarded-For
+# entries give the client IP used by the per client rate limit
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', '0'))
+if TRUSTED_PROXIES > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
 
 # Set up logging
 logging.config.fileConfig(fname='logfile.conf', disable_existing_loggers=False)
@@ -21,6 +38,54 @@ logging.config.fileConfig(fname='logfile.conf', disable_existing_loggers=False)
 logger = logging.getLogger(__name__)
 logger.debug('STARTING the Coffee Shop backend')
 
+# the largest page of drinks that can be asked for with ?limit=
+MAX_PAGE_LIMIT = int(os.getenv('MAX_PAGE_LIMIT', '1000'))
+# stream the full drinks lists instead of serving the in-memory snapshot,
+# for catalogues too big to hold in memory (also ?stream=true per request)
+STREAM_DRINK_LISTS = os.getenv('STREAM_DRINK_LISTS', '0') == '1'
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', '500'))
+# the most drinks accepted by one POST /drinks/bulk and the number of rows
+# sent to the database by each executemany
+BULK_MAX_DRINKS = int(os.getenv('BULK_MAX_DRINKS', '1000'))
+BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', '500'))
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl')
+# the most operations accepted by one POST /drinks/batch
+BATCH_MAX_OPERATIONS = int(os.getenv('BATCH_MAX_OPERATIONS', '100'))
+# the permission needed for each POST /drinks/batch operation
+BATCH_PERMISSIONS = {
+    'create': 'post:drinks',
+    'patch': 'patch:drinks',
+    'delete': 'delete:drinks'
+}
+
+# Set up rate limiting, per client IP for public endpoints and per JWT sub
+# for protected ones (a rate of 0, the default, turns a limiter off)
+bucket_store = bucket_store_from_env()
+read_limiter = RateLimiter('read',
+                           float(os.getenv('READ_RATE_LIMIT', '0')),
+                           int(os.getenv('READ_RATE_BURST', '100')),
+                           bucket_store)
+write_limiter = RateLimiter('write',
+                            float(os.getenv('WRITE_RATE_LIMIT', '0')),
+                            int(os.getenv('WRITE_RATE_BURST', '20')),
+                            bucket_store)
+
+# Set up group commits of the single drink writes, a window of 0 commits
+# each write on its own as soon as it is made
+WRITE_COALESCE_WINDOW = float(os.getenv('WRITE_COALESCE_WINDOW_MS', '0'))
+write_coalescer = None
+if WRITE_COALESCE_WINDOW > 0:
+    write_coalescer = WriteCoalescer(
+        app, window=WRITE_COALESCE_WINDOW / 1000.0,
+        max_batch=int(os.getenv('WRITE_COALESCE_MAX_BATCH', '100')))
+
+# Set up the Server-Sent Events stream of menu changes
+EVENT_HEARTBEAT = float(os.getenv('EVENT_HEARTBEAT', '15'))
+menu_events = MenuEventBroker(
+    max_subscribers=int(os.getenv('EVENT_MAX_SUBSCRIBERS', '1000')),
+    buffer_size=int(os.getenv('EVENT_BUFFER_SIZE', '100')))
+menu_change_listeners.append(menu_events.publish_change)
+
 '''
 @TODO uncomment the following line to initialize the datbase
 !! NOTE THIS WILL DROP ALL RECORDS AND START YOUR DB FROM SCRATCH
@@ -28,6 +93,346 @@ logger.debug('STARTING the Coffee Shop backend')
 '''
 db_drop_and_create_all()
 
+def menu_etag(version, form):
+    '''
+    Returns the strong ETag of a drinks list at a menu version.
+
+    @INPUTS
+        version: the menu version (see models.MenuVersion)
+        form: 'short' or 'long'
+    '''
+    return 'menu-' + str(version) + '-' + form
+
+
+def menu_response(body, etag, cache_control, total_count=None):
+    '''
+    Returns a pre-encoded json response with its ETag.
+
+    A body of None gives a 304 Not Modified response.
+    '''
+    if body is None:
+        response = Response(status=304)
+    else:
+        response = Response(body, status=200, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    if total_count is not None:
+        response.headers['X-Total-Count'] = str(total_count)
+    return response
+
+
+def page_args():
+    '''
+    Gets the ?limit= and ?after_id= pagination arguments.
+
+    Returns a tuple of (limit, after_id), limit is None if the request
+    is not paginated.
+    '''
+    limit = request.args.get('limit', None)
+    after_id = request.args.get('after_id', '0')
+    if limit is None:
+        return None, 0
+    try:
+        limit = int(limit)
+        after_id = int(after_id)
+    except ValueError:
+        abort(400, "limit and after_id must be integers.")
+    if limit < 1 or limit > MAX_PAGE_LIMIT:
+        abort(400, "limit must be between 1 and " + str(MAX_PAGE_LIMIT) + ".")
+    return limit, after_id
+
+
+def wants_stream():
+    '''
+    Returns True if the full drinks list should be streamed.
+    '''
+    stream = request.args.get('stream', None)
+    if stream is None:
+        return STREAM_DRINK_LISTS
+    return stream.lower() in ('1', 'true', 'yes')
+
+
+def stream_drinks(form):
+    '''
+    Returns the full drinks list as a streamed json response.
+
+    @INPUTS
+        form: 'short' or 'long'
+
+    The rows are read from the database in batches of STREAM_BATCH_SIZE,
+    each a short query finished before anything is sent, and each drink
+    is encoded and sent as it is read, so the memory used does not grow
+    with the number of drinks and a slow client does not block writes.
+    The json is the same as the unstreamed response.
+    '''
+    try:
+        total_count = get_drink_count()
+    except Exception as e:
+        abort(422, "Unexpected error accessing the database.")
+
+    if total_count == 0:
+        abort(404, 'There are no drinks')
+
+    def generate():
+        yield '{"drinks":['
+        separator = ''
+        try:
+            for drink in iter_drinks(STREAM_BATCH_SIZE):
+                # parsed without being kept, so memory stays flat
+                item = drink.long(cache=False) if form == 'long' \
+                    else drink.short(cache=False)
+                yield separator + json.dumps(item, separators=(',', ':'),
+                                             sort_keys=True)
+                separator = ','
+        except Exception as e:
+            # the status has already been sent, end with invalid json
+            logger.error('Error streaming the drinks: %s', e)
+            return
+        yield '],"success":true}\n'
+
+    response = Response(stream_with_context(generate()), status=200,
+                        mimetype='application/json')
+    response.headers['X-Total-Count'] = str(total_count)
+    return response
+
+
+def drinks_page(form, limit, after_id):
+    '''
+    Returns one page of the drinks list using the id as the cursor.
+
+    @INPUTS
+        form: 'short' or 'long'
+        limit: the page size
+        after_id: the id of the last drink on the previous page (0 for
+            the first page)
+    '''
+    try:
+        page = drinks_after(after_id, limit)
+        total_count = get_drink_count()
+    except Exception as e:
+        abort(422, "Unexpected error accessing the database.")
+
+    if total_count == 0:
+        abort(404, 'There are no drinks')
+
+    if form == 'long':
+        drinks = [drink.long() for drink in page]
+    else:
+        drinks = [drink.short() for drink in page]
+
+    response = jsonify({
+        'success': True,
+        'drinks': drinks,
+        'next_after_id': page[-1].id if len(page) == limit else None
+    })
+    response.headers['X-Total-Count'] = str(total_count)
+    return response, 200
+
+
+def bulk_drinks_body():
+    '''
+    Gets the drinks submitted to POST /drinks/bulk.
+
+    The body is either a json array of drinks (or an object with a
+    'drinks' array) or, with a Content-Type of application/x-ndjson, one
+    json drink per line.
+
+    Returns a tuple of the list of drinks and a dict of index to error
+    message for the ndjson lines that could not be parsed (those drinks
+    are None).
+    '''
+    errors = {}
+    if request.mimetype in NDJSON_MIMETYPES:
+        drinks = []
+        lines = request.get_data(as_text=True).splitlines()
+        for line in (line for line in lines if line.strip()):
+            try:
+                drinks.append(json.loads(line))
+            except ValueError:
+                errors[len(drinks)] = "Invalid json."
+                drinks.append(None)
+    else:
+        drinks = request.get_json(silent=True)
+        if isinstance(drinks, dict):
+            drinks = drinks.get('drinks', None)
+        if not isinstance(drinks, list):
+            abort(400, "Invalid input data. (an array of drinks is required.)")
+    return drinks, errors
+
+
+def drink_input_error(drink):
+    '''
+    Checks one drink submitted to POST /drinks/bulk.
+
+    Returns the same error message POST /drinks would give, or None if
+    the drink is valid.
+    '''
+    if not isinstance(drink, dict):
+        return "Invalid input data. (title and recipe are required.)"
+    title = drink.get('title', None)
+    recipe = drink.get('recipe', None)
+    if title is None and recipe is None:
+        return "Missing input field(s). (title and recipe are required.)"
+    if title is None:
+        return "Missing input field(s). (title is required.)"
+    if recipe is None:
+        return "Missing input field(s). (recipe is required.)"
+    if not isinstance(title, str):
+        return "The title must be a string."
+    if title == '':
+        return "The title must not be blank."
+    if recipe == '':
+        return "The recipe must not be blank."
+    return None
+
+
+class BatchOperationError(Exception):
+    '''
+    BatchOperationError Exception. Raised when one POST /drinks/batch
+    operation cannot be applied.
+    '''
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.message = message
+
+
+def check_batch_operation(jwt, operation):
+    '''
+    Checks one POST /drinks/batch operation before it is applied.
+
+    @INPUTS
+        jwt: the decoded jwt payload of the request
+        operation: the submitted operation
+
+    The permission is checked against the payload that was verified once
+    for the whole request.
+
+    Raises a BatchOperationError if the operation is invalid or the user
+    does not have the permission for it.
+    '''
+    if not isinstance(operation, dict) or \
+            operation.get('op', None) not in BATCH_PERMISSIONS:
+        raise BatchOperationError(
+            400, "Invalid operation. (op must be create, patch or delete.)")
+    try:
+        check_permissions(BATCH_PERMISSIONS[operation['op']], jwt)
+    except AuthError as e:
+        raise BatchOperationError(e.status_code, e.error['description'])
+
+    if operation['op'] == 'create':
+        message = drink_input_error(operation)
+        if message is not None:
+            raise BatchOperationError(400, message)
+        return
+    if not isinstance(operation.get('id', None), int):
+        raise BatchOperationError(400, "Missing input field(s). "
+                                       "(id is required.)")
+    if operation['op'] == 'patch':
+        title = operation.get('title', None)
+        recipe = operation.get('recipe', None)
+        if title is None and recipe is None:
+            raise BatchOperationError(400, "Missing input field(s). "
+                                           "(title or recipe are required.)")
+        if title == '' or recipe == '':
+            raise BatchOperationError(400, "Bad input field(s). "
+                                           "(title or recipe must not be "
+                                           "blank.)")
+
+
+def apply_batch_operation(operation):
+    '''
+    Applies one checked POST /drinks/batch operation in the current
+    transaction.
+
+    Raises a BatchOperationError if the drink is not found or the title
+    is already taken.
+
+    Returns a tuple of the change dict and the operation's result.
+    '''
+    op = operation['op']
+    title = operation.get('title', None)
+    recipe = operation.get('recipe', None)
+    if recipe is not None:
+        recipe = json.dumps(recipe)
+    if title is not None and title_taken(title, operation.get('id', None)):
+        raise BatchOperationError(400, "Cannot add '" + str(title) +
+                                  "'. That drink already exists in the "
+                                  "datbase.")
+
+    if op == 'create':
+        change = Drink.stage_create(title, recipe)
+    elif op == 'patch':
+        change = Drink.stage_update(operation['id'], title, recipe)
+    else:
+        change = Drink.stage_delete(operation['id'])
+    if change is None:
+        raise BatchOperationError(404, "id '" + str(operation['id']) +
+                                  "' not found in the database.")
+    if op == 'delete':
+        return change, {'delete': change['id']}
+    return change, {'drink': change['drink'].long()}
+
+
+def batch_error(index, error):
+    '''
+    Returns the result of a POST /drinks/batch operation that failed.
+    '''
+    return {
+        'index': index,
+        'success': False,
+        'error': error.status_code,
+        'message': error.message
+    }
+
+
+def create_drink(title, recipe):
+    '''
+    Inserts a new drink for POST /drinks.
+
+    @INPUTS
+        title: the title of the new drink
+        recipe: the recipe json string
+
+    The drink is committed on its own or, when WRITE_COALESCE_WINDOW_MS is
+    set, together with the other writes made within the window.
+
+    Returns the new drink (a Drink or a DrinkRecord).
+    '''
+    if write_coalescer is not None:
+        return write_coalescer.submit(
+            lambda: Drink.stage_create(title, recipe))['drink']
+    drink = Drink(title=title, recipe=recipe)
+    drink.insert()
+    return drink
+
+
+def update_drink(drink_id, title, recipe):
+    '''
+    Updates a drink for PATCH /drinks/<id>, committed as for create_drink.
+
+    Returns a DrinkRecord of the updated drink, or None if there is no
+    drink with that id.
+    '''
+    if write_coalescer is not None:
+        change = write_coalescer.submit(
+            lambda: Drink.stage_update(drink_id, title, recipe))
+        return change['drink'] if change is not None else None
+    return Drink.update_by_id(drink_id, title=title, recipe=recipe)
+
+
+def delete_drink(drink_id):
+    '''
+    Deletes a drink for DELETE /drinks/<id>, committed as for create_drink.
+
+    Returns True if the drink was deleted, or False if there is no drink
+    with that id.
+    '''
+    if write_coalescer is not None:
+        return write_coalescer.submit(
+            lambda: Drink.stage_delete(drink_id)) is not None
+    return Drink.delete_by_id(drink_id)
+
+
 # ROUTES
 
 
@@ -45,6 +450,7 @@ def index():
 
 
 @app.route('/drinks', methods=['GET'])
+@limit_by_client(read_limiter)
 def drinks():
     '''
     GET /drinks is a public endpoint returning a list of drinks.
@@ -52,34 +458,64 @@ def drinks():
     This is used to get a list of drinks in the drink.short() data format
     and is used to display the names and colours of the drinks.
 
+    The response has an ETag for the menu version and a request with a
+    matching If-None-Match header is answered with a 304 without reading
+    the drinks.
+
+    All of the drinks are returned unless ?limit=<n> is given, in which
+    case the first n drinks with an id greater than ?after_id= are
+    returned with "next_after_id", the after_id for the next page (null
+    on the last page). The X-Total-Count header is the number of drinks.
+
+    ?stream=true (or STREAM_DRINK_LISTS) streams the full list straight
+    from the database instead of serving the in-memory menu snapshot.
+
     Returns
         status code 200 and json {"success": True, "drinks": drinks}
             where drinks is the list of drinks
+        status code 304 if the drinks have not changed since the ETag
+        status code 400 if limit or after_id are invalid
         status code 404 if there are no drinks
         status code 422 if there is a database error
+        status code 429 if the client IP has made too many requests
+        status code 500 if a drink recipe has no short form
     '''
     logger.debug('GET /drinks')
-    # get all the drinks
+    limit, after_id = page_args()
+    if limit is not None:
+        return drinks_page('short', limit, after_id)
+
+    # answer a conditional request from the menu version alone
+    try:
+        version = menu_cache.current_version()
+    except Exception as e:
+        abort(422, "Unexpected error accessing the database.")
+    if request.if_none_match.contains(menu_etag(version, 'short')):
+        return menu_response(None, menu_etag(version, 'short'), 'no-cache')
+
+    if wants_stream():
+        return stream_drinks('short')
+
+    # get the menu snapshot, only built from the database after a change
     try:
-        all_drinks = Drink.query.all()
+        menu = menu_cache.get()
     except Exception as e:
         abort(422, "Unexpected error accessing the database.")
 
     # return a 404 error if there are no drinks
-    if len(all_drinks) is 0:
+    if menu.count == 0:
         abort(404, 'There are no drinks')
+    if menu.short_json is None:
+        abort(500, "A drink recipe has no short form.")
 
-    # get the short form of the drinks list
-    drinks = [drink.short() for drink in all_drinks]
-
-    return jsonify({
-        'success': True,
-        'drinks': drinks
-    }), 200
+    # return the pre-encoded short form of the drinks list
+    return menu_response(menu.short_json, menu_etag(menu.version, 'short'),
+                         'no-cache', total_count=menu.count)
 
 
 @app.route('/drinks-detail', methods=['GET'])
 @requires_auth('get:drinks-detail')
+@limit_by_subject(read_limiter)
 def drinks_detail(jwt):
     '''
     GET /drinks-detail is a protected endpoint returning a list of drinks.
@@ -89,36 +525,188 @@ def drinks_detail(jwt):
 
     Requires the 'get:drinks-detail' permission.
 
+    The response has an ETag for the menu version and a request with a
+    matching If-None-Match header is answered with a 304 without reading
+    the drinks.
+
+    ?limit=, ?after_id= and ?stream= work as for GET /drinks and the
+    X-Total-Count header is the number of drinks.
+
     Returns
         status code 200 and json {"success": True, "drinks": drinks}
             where drinks is the list of drinks in the drink.long() data format
+        status code 304 if the drinks have not changed since the ETag
+        status code 400 if limit or after_id are invalid
         status code 400 if there are no permissions in the JWT
         status code 401 if the user does not have permission to do this
         status code 404 if there are no drinks
         status code 422 if there is a database error
+        status code 429 if the user has made too many requests
     '''
     logger.debug('GET /drinks-detail')
-    # get all the drinks
+    limit, after_id = page_args()
+    if limit is not None:
+        return drinks_page('long', limit, after_id)
+
+    # answer a conditional request from the menu version alone
+    try:
+        version = menu_cache.current_version()
+    except Exception as e:
+        abort(422, "Unexpected error accessing the database.")
+    if request.if_none_match.contains(menu_etag(version, 'long')):
+        return menu_response(None, menu_etag(version, 'long'), 'private, no-cache')
+
+    if wants_stream():
+        return stream_drinks('long')
+
+    # get the menu snapshot, only built from the database after a change
     try:
-        all_drinks = Drink.query.all()
+        menu = menu_cache.get()
     except Exception as e:
         abort(422, "Unexpected error accessing the database.")
 
     # return an error if there are no drinks
-    if len(all_drinks) is 0:
+    if menu.count == 0:
         abort(404, 'There are no drinks')
 
-    # get the short form of the drinks list
-    drinks = [drink.long() for drink in all_drinks]
+    # return the pre-encoded long form of the drinks list
+    return menu_response(menu.long_json, menu_etag(menu.version, 'long'),
+                         'private, no-cache', total_count=menu.count)
+
+
+def drink_changes(form):
+    '''
+    Builds the response for GET /drinks/changes and /drinks-detail/changes.
+
+    @INPUTS
+        form: 'short' or 'long', the representation of the changed drinks
+    '''
+    since = request.args.get('since', None, type=int)
+    if since is None or since < 0:
+        abort(400, "Missing or invalid 'since' menu version.")
+
+    try:
+        version, reset, changed, deleted_ids = drink_changes_since(since)
+    except Exception as e:
+        abort(422, "Unexpected error accessing the database.")
+
+    if form == 'long':
+        upserts = [drink.long() for drink in changed]
+    else:
+        upserts = [drink.short() for drink in changed]
 
     return jsonify({
         'success': True,
-        'drinks': drinks
+        'version': version,
+        'reset': reset,
+        'upserts': upserts,
+        'deletes': deleted_ids
     }), 200
 
 
+@app.route('/drinks/changes', methods=['GET'])
+@limit_by_client(read_limiter)
+def drinks_changes():
+    '''
+    GET /drinks/changes?since=<version> is a public endpoint returning the
+    drinks changed after a menu version.
+
+    This is used by clients that already hold the menu to fetch only what
+    has changed, in the drink.short() data format. The version to ask from
+    next time is returned with the changes.
+
+    Returns
+        status code 200 and json {"success": True, "version": version,
+            "reset": reset, "upserts": drinks, "deletes": ids}
+            where drinks are the inserted or updated drinks and ids are the
+            ids of deleted drinks. If reset is True the changes from since
+            are no longer known, drinks is the whole menu and any drink
+            not in it must be dropped.
+        status code 400 if since is missing or invalid
+        status code 422 if there is a database error
+        status code 429 if the client IP has made too many requests
+    '''
+    logger.debug('GET /drinks/changes')
+    return drink_changes('short')
+
+
+@app.route('/drinks-detail/changes', methods=['GET'])
+@requires_auth('get:drinks-detail')
+@limit_by_subject(read_limiter)
+def drinks_detail_changes(jwt):
+    '''
+    GET /drinks-detail/changes?since=<version> is a protected endpoint
+    returning the drinks changed after a menu version.
+
+    This is the same as GET /drinks/changes but the drinks are in the
+    drink.long() data format.
+
+    Requires the 'get:drinks-detail' permission.
+
+    Returns
+        status code 200 and json {"success": True, "version": version,
+            "reset": reset, "upserts": drinks, "deletes": ids}
+            (see GET /drinks/changes)
+        status code 400 if since is missing or invalid
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have permission to do this
+        status code 422 if there is a database error
+        status code 429 if the user has made too many requests
+    '''
+    logger.debug('GET /drinks-detail/changes')
+    return drink_changes('long')
+
+
+@app.route('/drinks/events', methods=['GET'])
+def drinks_events():
+    '''
+    GET /drinks/events is a public Server-Sent Events stream of menu changes.
+
+    This is used by menu screens instead of polling GET /drinks. The events
+    are 'drink.created', 'drink.updated' and 'drink.deleted' with json data
+    {"id": id, "version": version, "drink": drink} where drink is in the
+    drink.short() data format (null when deleted), and 'menu.reset' when
+    the client must reload the whole menu. A comment line is sent every
+    EVENT_HEARTBEAT seconds when there are no changes.
+
+    A client that reconnects with a Last-Event-ID header gets the events it
+    missed.
+
+    Returns
+        status code 200 and a text/event-stream
+        status code 503 if there are too many subscribers
+    '''
+    logger.debug('GET /drinks/events')
+    last_event_id = request.headers.get('Last-Event-ID', None)
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    if request.method == 'HEAD':
+        # there is no body to stream, so do not take a subscriber slot
+        response = Response(mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    try:
+        subscriber = menu_events.subscribe(last_event_id)
+    except TooManySubscribersError:
+        abort(503, "Too many subscribers, try again later.")
+
+    response = Response(menu_events.stream(subscriber, EVENT_HEARTBEAT),
+                        mimetype='text/event-stream')
+    # the stream removes the subscriber when it ends, but a stream that
+    # is never started (i.e. the client went away first) would keep it
+    response.call_on_close(lambda: menu_events.unsubscribe(subscriber))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @app.route('/drinks', methods=['POST'])
 @requires_auth('post:drinks')
+@limit_by_subject(write_limiter)
 def drinks_create(jwt):
     '''
     POST /drinks is an endpoint to create a new row in the drinks table.
@@ -137,6 +725,7 @@ def drinks_create(jwt):
         status code 400 if there are no permissions in the JWT
         status code 401 if the user does not have the required permission
         status code 422 if there is a database error
+        status code 429 if the user has made too many requests
     '''
     logger.debug('POST/drinks')
 
@@ -162,31 +751,237 @@ def drinks_create(jwt):
     if new_recipe == '':
         abort(400, description="The recipe must not be blank.")
 
-    # ensure that the title is unique
-    existing_drink = Drink.query.filter(Drink.title == new_title).one_or_none()
-    if existing_drink is not None:
-        abort(400, description="Cannot add '" + new_title +
-              "'. That drink already exists in the datbase.")
     try:
         # start of a rollbackable transaction
-        # insert the new drink
-        drink = Drink(
-            title=new_title,
-            recipe=json.dumps(new_recipe)
-        )
-        drink.insert()
+        # insert the new drink, the unique constraint on the title rejects
+        # a drink that is already in the database (even one inserted by a
+        # concurrent request) so the title is not looked up first
+        drink = create_drink(new_title, json.dumps(new_recipe))
         # return the long form of the drink just inserted
         return jsonify({
             'success': True,
             'drinks': [drink.long()]
         }), 200
+    except exc.IntegrityError:
+        db_rollback()
+        abort(400, description="Cannot add '" + str(new_title) +
+              "'. That drink already exists in the datbase.")
     except Exception as e:
         db_rollback()
         abort(422, "Unexpected error inserting the drink into the database.")
 
 
+@app.route('/drinks/bulk', methods=['POST'])
+@requires_auth('post:drinks')
+@limit_by_subject(write_limiter)
+def drinks_bulk_create(jwt):
+    '''
+    POST /drinks/bulk is an endpoint to create many new drinks at once.
+
+    This is used to load a whole menu in one request. The body is a json
+    array of drinks in the drink.long() data representation, or one drink
+    per line with a Content-Type of application/x-ndjson.
+
+    Every drink is checked as POST /drinks would check it, the titles are
+    checked against the drinks table with a single query and then all of
+    the drinks are inserted in one transaction. If any drink is rejected
+    nothing is inserted.
+
+    Requires the 'post:drinks' permission.
+
+    Returns
+        status code 200 and json {"success": True, "drinks": drinks,
+            "created": count} where drinks is an array of the newly
+            created drinks in the order they were submitted
+        status code 400 and json {"success": False, "errors": errors}
+            where errors is an array of {"index": index, "message": message}
+            for every drink that was rejected
+        status code 400 if the body is not an array of drinks or has more
+            than BULK_MAX_DRINKS drinks
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have the required permission
+        status code 422 if there is a database error
+        status code 429 if the user has made too many requests
+    '''
+    logger.debug('POST/drinks/bulk')
+
+    drinks, errors = bulk_drinks_body()
+    if len(drinks) == 0:
+        abort(400, "Missing input data. (at least one drink is required.)")
+    if len(drinks) > BULK_MAX_DRINKS:
+        abort(400, "Too many drinks. (at most " + str(BULK_MAX_DRINKS) +
+              " can be added at once.)")
+
+    # check each drink and that the titles are unique within the request
+    first_index = {}
+    for index, drink in enumerate(drinks):
+        if index in errors:
+            continue
+        message = drink_input_error(drink)
+        if message is None and drink['title'] in first_index:
+            message = ("Cannot add '" + drink['title'] +
+                       "'. That drink is already at index " +
+                       str(first_index[drink['title']]) + ".")
+        if message is not None:
+            errors[index] = message
+        else:
+            first_index[drink['title']] = index
+
+    # ensure that the titles are not already in the database
+    try:
+        taken = existing_titles(list(first_index), BULK_BATCH_SIZE)
+    except Exception as e:
+        abort(422, "Unexpected error accessing the database.")
+    for title in taken:
+        errors[first_index[title]] = ("Cannot add '" + title +
+                                      "'. That drink already exists in the "
+                                      "datbase.")
+
+    if errors:
+        return jsonify({
+            'success': False,
+            'error': 400,
+            'message': str(len(errors)) + ' of ' + str(len(drinks)) +
+                       ' drinks were rejected, none were added.',
+            'errors': [{'index': index, 'message': errors[index]}
+                       for index in sorted(errors)]
+        }), 400
+
+    try:
+        # start of a rollbackable transaction
+        # insert all of the new drinks
+        records = Drink.bulk_insert(
+            [(drink['title'], json.dumps(drink['recipe'])) for drink in drinks],
+            BULK_BATCH_SIZE)
+        # return the long form of the drinks just inserted
+        return jsonify({
+            'success': True,
+            'drinks': [record.long() for record in records],
+            'created': len(records)
+        }), 200
+    except exc.IntegrityError:
+        # a title was taken by another request since it was checked
+        db_rollback()
+        abort(400, description="One or more of the drinks already exist in "
+              "the datbase, none were added.")
+    except Exception as e:
+        db_rollback()
+        abort(422, "Unexpected error inserting the drinks into the database.")
+
+
+@app.route('/drinks/batch', methods=['POST'])
+@requires_auth(list(BATCH_PERMISSIONS.values()), any_of=True)
+@limit_by_subject(write_limiter)
+def drinks_batch(jwt):
+    '''
+    POST /drinks/batch is an endpoint to apply many creates, patches and
+    deletes in one request.
+
+    This is used by tools that make many changes at once. The body is
+    json {"operations": operations, "atomic": atomic} where operations is
+    an array of
+        {"op": "create", "title": title, "recipe": recipe}
+        {"op": "patch", "id": id, "title": title, "recipe": recipe}
+        {"op": "delete", "id": id}
+    checked as POST, PATCH and DELETE would check them.
+
+    The JWT is verified once for the whole request and each operation is
+    checked against the permission its endpoint requires ('post:drinks',
+    'patch:drinks' or 'delete:drinks'). The operations are applied in
+    order in one transaction. When atomic is true (the default) any
+    failed operation means none are applied, otherwise the operations
+    that failed are skipped and the others are applied.
+
+    Requires at least one of the 'post:drinks', 'patch:drinks' and
+    'delete:drinks' permissions.
+
+    Returns
+        status code 200 and json {"success": True, "results": results,
+            "applied": count} where results has one entry for each
+            operation: {"index": index, "success": True, "drink": drink}
+            for a create or patch, {"index": index, "success": True,
+            "delete": id} for a delete or {"index": index,
+            "success": False, "error": status, "message": message} for an
+            operation that failed
+        status code 400 and json {"success": False, "errors": errors}
+            when atomic is true and any operation failed, where errors
+            are the results of the failed operations
+        status code 400 if the body is not an array of operations or has
+            more than BATCH_MAX_OPERATIONS operations
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user has none of the permissions
+        status code 422 if there is a database error
+        status code 429 if the user has made too many requests
+    '''
+    logger.debug('POST/drinks/batch')
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or \
+            not isinstance(body.get('operations', None), list):
+        abort(400, "Invalid input data. (an array of operations is "
+                   "required.)")
+    operations = body['operations']
+    atomic = body.get('atomic', True) is not False
+    if len(operations) == 0:
+        abort(400, "Missing input data. (at least one operation is "
+                   "required.)")
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        abort(400, "Too many operations. (at most " +
+              str(BATCH_MAX_OPERATIONS) + " can be applied at once.)")
+
+    # check every operation and its permission before touching the database
+    results = [None] * len(operations)
+    for index, operation in enumerate(operations):
+        try:
+            check_batch_operation(jwt, operation)
+        except BatchOperationError as e:
+            results[index] = batch_error(index, e)
+
+    changes = []
+    try:
+        # start of a rollbackable transaction
+        # apply the operations in order
+        for index, operation in enumerate(operations):
+            if results[index] is not None:
+                continue
+            try:
+                change, result = apply_batch_operation(operation)
+            except BatchOperationError as e:
+                results[index] = batch_error(index, e)
+                continue
+            changes.append(change)
+            results[index] = dict(result, index=index, success=True)
+
+        errors = [result for result in results if not result['success']]
+        if atomic and errors:
+            db_rollback()
+            return jsonify({
+                'success': False,
+                'error': 400,
+                'message': str(len(errors)) + ' of ' + str(len(operations)) +
+                           ' operations failed, none were applied.',
+                'errors': errors
+            }), 400
+
+        commit_changes(changes)
+        return jsonify({
+            'success': True,
+            'results': results,
+            'applied': len(changes)
+        }), 200
+    except exc.IntegrityError:
+        # a title was taken by another request since it was checked
+        db_rollback()
+        abort(400, description="One or more of the drinks already exist in "
+              "the datbase, none of the operations were applied.")
+    except Exception as e:
+        db_rollback()
+        abort(422, "Unexpected error updating the database.")
+
+
 @app.route('/drinks/<int:id>', methods=['PATCH'])
 @requires_auth('patch:drinks')
+@limit_by_subject(write_limiter)
 def drinks_patch(jwt, id):
     '''
     PATCH /drinks/<id> is an endpoint to update the corresponding row for <id>.
@@ -207,6 +1002,7 @@ def drinks_patch(jwt, id):
         status code 401 if the user does not have permission to do this
         status code 404 if <id> is not found in the database
         status code 422 if there is a database error
+        status code 429 if the user has made too many requests
     '''
     logger.debug('PATCH/drinks/' + str(id))
 
@@ -226,33 +1022,30 @@ def drinks_patch(jwt, id):
     if new_title == '' or new_recipe == '':
         abort(400, "Bad input field(s). (title or recipe must not be blank.)")
 
-    # get the drink to patch
-    drink = Drink.query.filter(Drink.id == id).one_or_none()
-    if drink is None:
-        abort(404, "id not found in the database.")
-
     try:
         # start of a rollbackable transaction
-        # insert the new data to the drink
-        if new_title is not None:
-            drink.title = new_title
-        if new_recipe is not None:
-            drink.recipe = json.dumps(new_recipe)
-        drink.update()
-
-        # return the long form of the drink just inserted
-        return jsonify({
-            'success': True,
-            'drinks': [drink.long()]
-        }), 200
-
+        # update the drink in place, the number of rows updated tells
+        # whether the drink exists so it is not loaded first
+        drink = update_drink(
+            id, new_title,
+            json.dumps(new_recipe) if new_recipe is not None else None)
     except Exception as e:
         db_rollback()
         abort(422, "Unexpected error updating the database.")
 
+    if drink is None:
+        abort(404, "id not found in the database.")
+
+    # return the long form of the drink just updated
+    return jsonify({
+        'success': True,
+        'drinks': [drink.long()]
+    }), 200
+
 
 @app.route('/drinks/<int:id>', methods=['DELETE'])
 @requires_auth('delete:drinks')
+@limit_by_subject(write_limiter)
 def drinks_delete(jwt, id):
     '''
     DELETE /drinks/<id> is an endpoint to delete the existing row for <id>.
@@ -272,28 +1065,56 @@ def drinks_delete(jwt, id):
         status code 401 if the user does not have permission to do this
         status code 404 if <id> is not found in the database
         status code 422 if there is a database error
+        status code 429 if the user has made too many requests
     '''
     logger.debug('DELETE/drinks/' + str(id))
 
-    # get the drink to be deleted
-    drink = Drink.query.filter(Drink.id == id).one_or_none()
-    if drink is None:
-        abort(404, "id '" + str(id) + "' not found in the database.")
     try:
         # start of a rollbackable transaction
-        # delete the drink from the database
-        drink.delete()
-
-        # return the id of the deleted item
-        return jsonify({
-            'success': True,
-            'delete': id
-        }), 200
-
+        # delete the drink from the database, the number of rows deleted
+        # tells whether the drink exists so it is not loaded first
+        deleted = delete_drink(id)
     except Exception as e:
         db_rollback()
         abort(422, "Unexpected error deleting the drink from the database.")
 
+    if not deleted:
+        abort(404, "id '" + str(id) + "' not found in the database.")
+
+    # return the id of the deleted item
+    return jsonify({
+        'success': True,
+        'delete': id
+    }), 200
+
+
+@app.route('/metrics/auth', methods=['GET'])
+def auth_metrics_report():
+    '''
+    GET /metrics/auth is an endpoint reporting the requires_auth timings.
+
+    This is used to see where authentication time is spent. The phases
+    are header, token_cache, prevalidate, jwks, decode, permissions and
+    total.
+
+    Returns
+        status code 200 and json {"success": True, "phases": phases,
+            "token_cache": stats, "rejected_tokens": stats, "jwks": stats}
+            where phases maps each phase to a millisecond histogram
+            and jwks maps each trusted issuer to its key set stats
+        status code 404 if AUTH_TIMING is not enabled
+    '''
+    if not auth_metrics.enabled:
+        abort(404, 'Auth timing is not enabled.')
+
+    return jsonify({
+        'success': True,
+        'phases': auth_metrics.snapshot(),
+        'token_cache': token_cache.stats(),
+        'rejected_tokens': rejected_tokens.stats(),
+        'jwks': trusted_issuers.stats()
+    }), 200
+
 
 # ERROR HANDLING
 
@@ -307,6 +1128,17 @@ def handle_auth_error_json(error):
     }), error.status_code
 
 
+@app.errorhandler(RateLimitError)
+def rate_limit_error_json(error):
+    response = jsonify({
+        "success": False,
+        "error": error.status_code,
+        "message": str(error.error['description'])
+    })
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, error.status_code
+
+
 @app.errorhandler(400)
 def bad_request_error_json(error):
     return jsonify({
@@ -352,6 +1184,15 @@ def unprocessable_error_json(error):
     }), 422
 
 
+@app.errorhandler(503)
+def service_unavailable_error_json(error):
+    return jsonify({
+        "success": False,
+        "error": 503,
+        "message": str(error)
+    }), 503
+
+
 @app.errorhandler(500)
 def internal_error_json(error):
     return jsonify({
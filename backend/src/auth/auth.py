@@ -2,10 +2,18 @@ import json
 import logging
 import logging.config
 import os
-from flask import request, abort, _request_ctx_stack
+import re
+import sys
+import time
+from flask import request, abort, g, _request_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from jose.utils import base64url_decode
+
+from .issuers import IssuerRegistry, parse_tenants
+from .jwks import JWKSUnavailableError, verify_signature
+from .timing import AuthMetrics
+from .token_cache import RejectedTokenCache, TokenCache
 
 import ssl
 ssl._create_default_https_context = ssl._create_unverified_context
@@ -20,15 +28,69 @@ AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN', 'johnatborpa.au.auth0.com')
 API_AUDIENCE = os.getenv('API_AUDIENCE', 'coffeeshop')
 ALGORITHM = os.getenv('ALGORITHM', 'RS256')
 ALGORITHMS = [ALGORITHM]
+AUTH0_TENANTS = os.getenv('AUTH0_TENANTS', AUTH0_DOMAIN)
+JWKS_CACHE_TTL = int(os.getenv('JWKS_CACHE_TTL', '600'))
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv('JWKS_MIN_REFRESH_INTERVAL', '30'))
+JWKS_FETCH_TIMEOUT = float(os.getenv('JWKS_FETCH_TIMEOUT', '5'))
+JWKS_BACKGROUND_REFRESH = os.getenv('JWKS_BACKGROUND_REFRESH', '1') == '1'
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '1024'))
+REJECTED_TOKEN_CACHE_SIZE = int(os.getenv('REJECTED_TOKEN_CACHE_SIZE', '4096'))
+REJECTED_TOKEN_CACHE_TTL = int(os.getenv('REJECTED_TOKEN_CACHE_TTL', '60'))
+MIN_TOKEN_LENGTH = 32
+MAX_TOKEN_LENGTH = int(os.getenv('MAX_TOKEN_LENGTH', '8192'))
+TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+$')
+AUTH_TIMING = os.getenv('AUTH_TIMING', '0') == '1'
 
 # ### DEBUGGING START
 logger.debug('#### ABOUT TO SHOW ENVIRONMENT VARIABLES START')
 logger.debug('algorithms:%s:', ALGORITHMS)
 logger.debug('audience:%s:', API_AUDIENCE)
 logger.debug('domain:%s:', AUTH0_DOMAIN)
+logger.debug('tenants:%s:', AUTH0_TENANTS)
 logger.debug('#### ABOUT TO SHOW ENVIRONMENT VARIABLES END')
 # ### DEBUGGING END
 
+# each trusted Auth0 tenant has its own audience and cached key set, the
+# key sets are cached rather than downloaded for every request
+# (set JWKS_FILE to use a local key set instead of Auth0)
+trusted_issuers = IssuerRegistry.from_tenants(
+    parse_tenants(AUTH0_TENANTS, API_AUDIENCE),
+    algorithm=ALGORITHM,
+    timeout=JWKS_FETCH_TIMEOUT,
+    default_ttl=JWKS_CACHE_TTL,
+    min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL)
+# keep the key sets warm so request threads never wait on Auth0
+if JWKS_BACKGROUND_REFRESH:
+    trusted_issuers.start()
+
+# tokens that have already been verified are not verified again until exp
+token_cache = TokenCache(maxsize=TOKEN_CACHE_SIZE)
+
+# tokens that have just failed verification are rejected straight away
+rejected_tokens = RejectedTokenCache(maxsize=REJECTED_TOKEN_CACHE_SIZE,
+                                     ttl=REJECTED_TOKEN_CACHE_TTL)
+# these errors may go away without the token changing so are not remembered
+RETRYABLE_ERROR_CODES = ('jwks_unavailable', 'unknown_key')
+
+# per-phase timings of requires_auth, only collected if AUTH_TIMING is set
+auth_metrics = AuthMetrics(enabled=AUTH_TIMING)
+
+
+def record_phase(phase, start):
+    '''
+    Records the time since start for a phase of requires_auth.
+
+    @INPUTS
+        phase: the name of the phase (i.e. 'decode')
+        start: the time.perf_counter() value when the phase started
+
+    The duration goes into the auth_metrics histogram for the phase and
+    into g.auth_timings so it can be logged with the request.
+    '''
+    elapsed = time.perf_counter() - start
+    auth_metrics.record(phase, elapsed)
+    g.setdefault('auth_timings', {})[phase] = elapsed
+
 
 class AuthError(Exception):
     '''
@@ -88,18 +150,104 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
+def check_token_structure(token):
+    '''
+    Cheaply rejects tokens that cannot possibly be valid.
+
+    @INPUTS
+        token: a json web token (string)
+
+    Checks the length, that there are three base64url segments and that
+    the header is json naming an allowed alg and a kid, all without any
+    key lookup or signature check.
+
+    Raises an AuthError if the token is malformed.
+    '''
+    if (not MIN_TOKEN_LENGTH <= len(token) <= MAX_TOKEN_LENGTH or
+            TOKEN_PATTERN.match(token) is None):
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, 401)
+
+    try:
+        header_segment = token.split('.', 1)[0].encode('ascii')
+        header = json.loads(base64url_decode(header_segment).decode('utf-8'))
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+
+    if not isinstance(header, dict) or 'kid' not in header:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, 401)
+
+    if header.get('alg') not in ALGORITHMS:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+
+
+class VerifiedPayload(dict):
+    '''
+    VerifiedPayload - a decoded jwt payload that has passed verification.
+
+    It is a plain dict to the endpoints. The permissions claim is compiled
+    into a frozenset of interned strings the first time it is needed and
+    kept with the payload, so a token served from the token cache never
+    has its permissions list scanned again.
+    '''
+    __slots__ = ('_permission_set',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._permission_set = None
+
+    @property
+    def permission_set(self):
+        if self._permission_set is None:
+            self._permission_set = compile_permissions(
+                self.get('permissions', ()))
+        return self._permission_set
+
+
+def compile_permissions(permissions):
+    '''
+    Compiles permission strings into a frozenset of interned strings.
+
+    @INPUTS
+        permissions: a permission string (i.e. 'post:drinks') or an
+            iterable of them (i.e. ['post:drinks', 'patch:drinks'])
+
+    Returns the frozenset (returned unchanged if it already is one).
+    '''
+    if isinstance(permissions, frozenset):
+        return permissions
+    if isinstance(permissions, str):
+        permissions = (permissions,)
+    return frozenset(sys.intern(permission) for permission in permissions
+                     if isinstance(permission, str))
+
+
+def check_permissions(permission, payload, any_of=False):
     '''
     Checks that the user has the appropriate remissions in the JWT.
 
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink') or a list or
+            compiled set of them
         payload: decoded jwt payload
+        any_of: True if any one of the permissions is enough, otherwise
+            all of them are required
 
     Raises an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
 
-    Raise an AuthError if the requested permission string is not in the
+    Raise an AuthError if the requested permission strings are not in the
     payload permissions array.
 
     Returns True otherwise.
@@ -110,7 +258,17 @@ def check_permissions(permission, payload):
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    required = compile_permissions(permission)
+    if isinstance(payload, VerifiedPayload):
+        granted = payload.permission_set
+    else:
+        granted = compile_permissions(payload['permissions'])
+
+    if any_of:
+        allowed = not required.isdisjoint(granted)
+    else:
+        allowed = required <= granted
+    if not allowed:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -125,9 +283,11 @@ def verify_decode_jwt(token):
     @INPUTS
         token: a json web token (string)
 
-    The token should be an Auth0 token with key id (kid).
+    The token should be an Auth0 token with key id (kid) issued by one
+    of the trusted issuers (AUTH0_TENANTS).
 
-    Verifies the token using Auth0 /.well-known/jwks.json
+    Verifies the token using the issuer's Auth0 /.well-known/jwks.json
+    (the key set is cached, see jwks.JWKSCache)
 
     Decodes the payload from the token.
 
@@ -138,11 +298,8 @@ def verify_decode_jwt(token):
     !!NOTE urlopen has a common certificate error described here:
     https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
     '''
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
     # logger.debug('a')
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
@@ -150,25 +307,53 @@ def verify_decode_jwt(token):
         }, 401)
 
     # logger.debug('b')
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    timed = auth_metrics.enabled
+    if timed:
+        start = time.perf_counter()
+    # pick the tenant from the unverified iss claim, the claim is checked
+    # against the same issuer when the token is decoded
+    try:
+        unverified_claims = jwt.get_unverified_claims(token)
+    except jwt.JWTError:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+    issuer = trusted_issuers.get(unverified_claims.get('iss'))
+    if issuer is None:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Incorrect claims. Check audience and issuer.'
+        }, 401)
+    # the key registry holds ready built key objects so the signature can
+    # be checked without re-parsing the modulus and exponent
+    try:
+        key = issuer.jwks_cache.get_key(unverified_header['kid'])
+    except JWKSUnavailableError:
+        logger.debug('Unable to fetch the signing keys.')
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys.'
+        }, 503)
+    if timed:
+        record_phase('jwks', start)
+        start = time.perf_counter()
     # logger.debug('c')
-    if rsa_key:
+    if key is not None:
         try:
+            if unverified_header.get('alg') not in ALGORITHMS:
+                raise jwt.JWTError('The specified alg value is not allowed')
+            verify_signature(token, key)
             payload = jwt.decode(
                 token,
-                rsa_key,
+                '',
                 algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                audience=issuer.audience,
+                issuer=issuer.issuer,
+                options={'verify_signature': False}
             )
+            if timed:
+                record_phase('decode', start)
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -192,34 +377,99 @@ def verify_decode_jwt(token):
             }, 400)
     # logger.debug('d')
     raise AuthError({
-        'code': 'invalid_header',
+        'code': 'unknown_key',
         'description': 'Unable to find the appropriate key.'
     }, 400)
 
 
-def requires_auth(permission=''):
+def verify_new_token(token):
+    '''
+    Verifies a token that is not in the token cache.
+
+    @INPUTS
+        token: a json web token (string)
+
+    A token that was rejected in the last REJECTED_TOKEN_CACHE_TTL seconds
+    gets the same AuthError again straight away. Otherwise the token is
+    checked with check_token_structure before verify_decode_jwt so junk
+    tokens never reach the key set or the signature check.
+
+    Returns the decoded payload as a VerifiedPayload, which is added to
+    the token cache.
+    '''
+    rejected = rejected_tokens.get(token)
+    if rejected is not None:
+        raise AuthError(*rejected)
+
+    try:
+        if auth_metrics.enabled:
+            start = time.perf_counter()
+            check_token_structure(token)
+            record_phase('prevalidate', start)
+        else:
+            check_token_structure(token)
+        payload = VerifiedPayload(verify_decode_jwt(token))
+    except AuthError as e:
+        if e.error.get('code') not in RETRYABLE_ERROR_CODES:
+            rejected_tokens.put(token, e.error, e.status_code)
+        raise
+
+    token_cache.put(token, payload)
+    return payload
+
+
+def requires_auth(permission='', any_of=False):
     '''
     @requires_auth(permission) decorator method.
 
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink') or a list of
+            them (i.e. ['patch:drinks', 'delete:drinks'])
+        any_of: True if any one of the listed permissions is enough,
+            otherwise all of them are required
 
     Uses the get_token_auth_header method to get the token.
 
-    Uses the verify_decode_jwt method to decode the jwt.
+    Uses the verify_new_token method to check and decode the jwt unless
+    the token has already been verified and is still in the token cache.
 
     Uses the check_permissions method to validate claims and
     check the requested permission.
 
+    If AUTH_TIMING is set the duration of each phase is recorded in
+    auth_metrics and g.auth_timings.
+
     Returns the decorator which passes the decoded payload to the
     decorated method.
     '''
+    required = compile_permissions(permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            if not auth_metrics.enabled:
+                token = get_token_auth_header()
+                payload = token_cache.get(token)
+                if payload is None:
+                    payload = verify_new_token(token)
+                check_permissions(required, payload, any_of)
+                return f(payload, *args, **kwargs)
+
+            started = start = time.perf_counter()
+            try:
+                token = get_token_auth_header()
+                record_phase('header', start)
+                start = time.perf_counter()
+                payload = token_cache.get(token)
+                record_phase('token_cache', start)
+                if payload is None:
+                    payload = verify_new_token(token)
+                start = time.perf_counter()
+                check_permissions(required, payload, any_of)
+                record_phase('permissions', start)
+            finally:
+                record_phase('total', started)
+                logger.debug('requires_auth timings %s', g.auth_timings)
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
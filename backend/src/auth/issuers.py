@@ -0,0 +1,93 @@
+import logging
+
+from .jwks import JWKSCache
+from .providers import key_provider_from_env
+
+# Get the logger specified in the file
+logger = logging.getLogger(__name__)
+
+
+def parse_tenants(tenants, default_audience):
+    '''
+    Parses the AUTH0_TENANTS setting.
+
+    @INPUTS
+        tenants: comma separated Auth0 domains, each optionally followed
+            by =audience (i.e. 'a.auth0.com=coffeeshop,b.auth0.com')
+        default_audience: the audience for domains without one
+
+    Returns a list of (domain, audience) tuples.
+    '''
+    parsed = []
+    for tenant in tenants.split(','):
+        tenant = tenant.strip()
+        if not tenant:
+            continue
+        domain, _, audience = tenant.partition('=')
+        parsed.append((domain.strip(), audience.strip() or default_audience))
+    return parsed
+
+
+class Issuer:
+    '''
+    Issuer - a trusted Auth0 tenant with its own audience and key set.
+    '''
+    def __init__(self, domain, audience, jwks_cache):
+        self.domain = domain
+        self.audience = audience
+        self.issuer = 'https://' + domain + '/'
+        self.jwks_cache = jwks_cache
+
+
+class IssuerRegistry:
+    '''
+    IssuerRegistry - the trusted issuers indexed by their iss claim.
+
+    Tokens are matched to an issuer with a dict lookup on the unverified
+    iss claim, which then supplies the key set, audience and issuer to
+    verify the token against. Each issuer's key set is cached (and
+    refreshed) separately, so serving several tenants adds no round trips.
+    '''
+    def __init__(self, issuers):
+        self._issuers = {issuer.issuer: issuer for issuer in issuers}
+
+    @classmethod
+    def from_tenants(cls, tenants, algorithm, timeout, default_ttl,
+                     min_refresh_interval):
+        '''
+        Builds the registry for a list of (domain, audience) tuples.
+        '''
+        issuers = []
+        for domain, audience in tenants:
+            provider = key_provider_from_env(domain, timeout=timeout,
+                                             default_ttl=default_ttl)
+            jwks_cache = JWKSCache(provider, algorithm=algorithm,
+                                   min_refresh_interval=min_refresh_interval)
+            issuers.append(Issuer(domain, audience, jwks_cache))
+            logger.debug('Trusting issuer %s for audience %s',
+                         domain, audience)
+        return cls(issuers)
+
+    def get(self, iss):
+        '''
+        Returns the Issuer for an iss claim or None if it is not trusted.
+        '''
+        if not isinstance(iss, str):
+            return None
+        return self._issuers.get(iss)
+
+    def __iter__(self):
+        return iter(self._issuers.values())
+
+    def start(self):
+        '''
+        Starts the background key set refresher for every issuer.
+        '''
+        for issuer in self:
+            issuer.jwks_cache.start()
+
+    def stats(self):
+        '''
+        Returns a dict of issuer domain to key set stats.
+        '''
+        return {issuer.domain: issuer.jwks_cache.stats() for issuer in self}
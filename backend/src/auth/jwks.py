@@ -0,0 +1,332 @@
+import binascii
+import logging
+import threading
+import time
+
+from jose import jwk
+from jose.exceptions import JWKError, JWSError
+from jose.utils import base64url_decode
+
+from .providers import UrlKeyProvider
+
+# Get the logger specified in the file
+logger = logging.getLogger(__name__)
+
+def build_key_registry(jwks, algorithm):
+    '''
+    Builds the verifier key objects for a key set.
+
+    @INPUTS
+        jwks: a decoded JSON Web Key Set
+        algorithm: the algorithm to use for keys without an alg
+
+    Keys without a kid or that cannot be constructed are skipped.
+
+    Returns a dict of kid to jose key object.
+    '''
+    registry = {}
+    for key in jwks.get('keys', []):
+        if 'kid' not in key:
+            continue
+        try:
+            registry[key['kid']] = jwk.construct(key,
+                                                 key.get('alg', algorithm))
+        except JWKError as e:
+            logger.debug('Skipping JWKS key %s: %s', key['kid'], e)
+    return registry
+
+
+def verify_signature(token, key):
+    '''
+    Verifies the signature of a token with a prebuilt key object.
+
+    @INPUTS
+        token: a json web token (string)
+        key: a jose key object from the key registry
+
+    Raises a JWSError if the token is malformed or the signature does
+    not match.
+    '''
+    if isinstance(token, str):
+        token = token.encode('utf-8')
+    try:
+        signing_input, crypto_segment = token.rsplit(b'.', 1)
+        signature = base64url_decode(crypto_segment)
+    except (ValueError, TypeError, binascii.Error):
+        raise JWSError('Invalid crypto segment')
+    if not key.verify(signing_input, signature):
+        raise JWSError('Signature verification failed.')
+
+
+class JWKSUnavailableError(Exception):
+    '''
+    JWKSUnavailableError Exception. Raised when there is no key set to
+    verify tokens with and the identity provider cannot be reached.
+    '''
+    pass
+
+
+class CircuitBreaker:
+    '''
+    CircuitBreaker - tracks fetch failures and spaces out retries.
+
+    Each consecutive failure doubles the delay before the next attempt,
+    from base_delay up to max_delay. Once failure_threshold failures have
+    been recorded the breaker is open and no attempt is allowed until the
+    delay has passed, at which point a single trial attempt is allowed
+    (half open). A success closes the breaker again.
+    '''
+    def __init__(self, failure_threshold=3, base_delay=1.0, max_delay=300.0):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        '''
+        Returns True if an attempt may be made now.
+        '''
+        return time.monotonic() >= self._retry_at
+
+    def retry_in(self):
+        '''
+        Returns the number of seconds until an attempt is allowed.
+        '''
+        return max(0.0, self._retry_at - time.monotonic())
+
+    @property
+    def state(self):
+        '''
+        Returns 'closed', 'open' or 'half-open'.
+        '''
+        if self.failures < self.failure_threshold:
+            return 'closed'
+        return 'half-open' if self.allow() else 'open'
+
+    def record_success(self):
+        '''
+        Closes the breaker after a successful attempt.
+        '''
+        with self._lock:
+            self.failures = 0
+            self._retry_at = 0.0
+
+    def record_failure(self):
+        '''
+        Records a failed attempt and returns the delay before the next one.
+        '''
+        with self._lock:
+            self.failures += 1
+            delay = min(self.max_delay,
+                        self.base_delay * 2 ** (self.failures - 1))
+            self._retry_at = time.monotonic() + delay
+            return delay
+
+
+class JWKSCache:
+    '''
+    JWKSCache - an in-process cache of a JSON Web Key Set.
+
+    The key set comes from a key provider (see providers.py) and is kept
+    warm by a background refresher thread which fetches it again shortly
+    before the lifetime given by the provider runs out.
+
+    Request threads never wait on the identity provider once a key set
+    has been fetched. An expired key set is still served (stale while
+    revalidate) while the refresher fetches a new one, and if the
+    fetches keep failing the last known good keys are used until the
+    identity provider recovers. Fetches have a timeout and failures back
+    off exponentially through a CircuitBreaker. Only the very first fetch,
+    when there are no keys at all, is made on a request thread; if that
+    is not possible a JWKSUnavailableError is raised.
+
+    Each key is turned into a verifier key object once, when the key set
+    is fetched, and the kid-indexed registry of key objects is replaced
+    as a whole so readers never see a partly built registry.
+
+    A token with a kid that is not in the cached key set asks the
+    refresher for a new key set (the identity provider may have rotated
+    its keys) but these requests are limited to one per
+    min_refresh_interval seconds so a flood of forged kids cannot become
+    a flood of outbound fetches.
+    '''
+    def __init__(self, provider, algorithm='RS256', min_refresh_interval=30,
+                 refresh_ahead=0.8, breaker=None):
+        if isinstance(provider, str):
+            provider = UrlKeyProvider(provider)
+        self.provider = provider
+        self.algorithm = algorithm
+        self.min_refresh_interval = min_refresh_interval
+        self.refresh_ahead = refresh_ahead
+        self.breaker = breaker or CircuitBreaker()
+        # (jwks, registry, expires_at, refresh_at) replaced as one value
+        self._state = None
+        self._fetch_lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._refresh_requested = False
+        self._last_forced = 0.0
+        self._thread = None
+        self._stopped = False
+
+    def fetch(self):
+        '''
+        Gets the key set from the provider.
+
+        Returns a tuple of the decoded key set and its lifetime in seconds.
+        '''
+        return self.provider.fetch()
+
+    def refresh(self):
+        '''
+        Fetches the key set and replaces the cached keys.
+
+        Raises the fetch error (after recording it with the circuit
+        breaker) if the key set could not be fetched.
+        '''
+        with self._fetch_lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        try:
+            jwks, ttl = self.fetch()
+            registry = build_key_registry(jwks, self.algorithm)
+        except Exception as e:
+            delay = self.breaker.record_failure()
+            logger.warning('JWKS fetch failed (%s), retrying in %.1fs',
+                           e, delay)
+            raise
+        self.breaker.record_success()
+        # no-cache or max-age=0 must not turn the refresher into a fetch
+        # loop, the keys are kept for at least min_refresh_interval
+        ttl = max(ttl, self.min_refresh_interval, 1)
+        now = time.monotonic()
+        self._state = (jwks, registry, now + ttl,
+                       now + ttl * self.refresh_ahead)
+
+    def start(self):
+        '''
+        Starts the background refresher thread if it is not running.
+        '''
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run,
+                                            name='jwks-refresher',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the background refresher thread.
+        '''
+        self._stopped = True
+        self._wake.set()
+
+    def _seconds_until_refresh(self):
+        if not self.breaker.allow():
+            return self.breaker.retry_in()
+        state = self._state
+        if self._refresh_requested or state is None:
+            return 0.0
+        return max(0.0, state[3] - time.monotonic())
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self._seconds_until_refresh())
+            self._wake.clear()
+            if self._stopped:
+                break
+            if self._seconds_until_refresh() > 0:
+                continue
+            self._refresh_requested = False
+            try:
+                self.refresh()
+            except Exception:
+                # the failure has been logged and the breaker has backed off
+                pass
+
+    def request_refresh(self):
+        '''
+        Asks the background refresher to fetch the key set now.
+        '''
+        self._refresh_requested = True
+        self.start()
+        self._wake.set()
+
+    def _get_state(self):
+        state = self._state
+        if state is not None:
+            if time.monotonic() >= state[2]:
+                # serve the stale keys while the refresher catches up
+                self.request_refresh()
+            return state
+
+        # cold start, there is nothing to serve so fetch on this thread
+        if not self.breaker.allow():
+            raise JWKSUnavailableError('Identity provider unavailable.')
+        try:
+            with self._fetch_lock:
+                # the refresher may have fetched it while we waited
+                if self._state is None:
+                    self._refresh_locked()
+        except Exception as e:
+            raise JWKSUnavailableError(str(e))
+        self.start()
+        return self._state
+
+    def get_jwks(self):
+        '''
+        Returns the key set, fetching it only if there is none at all.
+        '''
+        return self._get_state()[0]
+
+    def get_key(self, kid):
+        '''
+        Gets the key with the given kid.
+
+        @INPUTS
+            kid: the key id from the token header
+
+        Asks the refresher for a new key set if the kid is unknown and this
+        has not been done in the last min_refresh_interval seconds. The
+        request is not held up waiting for it.
+
+        Returns the jose key object or None if there is no such key.
+        '''
+        key = self._get_state()[1].get(kid)
+        if key is not None:
+            return key
+
+        now = time.monotonic()
+        if now - self._last_forced < self.min_refresh_interval:
+            logger.debug('Unknown kid %s, refresh rate limited', kid)
+            return None
+        self._last_forced = now
+        logger.debug('Unknown kid %s, refreshing JWKS', kid)
+        self.request_refresh()
+        return None
+
+    def stats(self):
+        '''
+        Returns a dict describing the cached key set and the breaker.
+        '''
+        state = self._state
+        now = time.monotonic()
+        return {
+            'keys': 0 if state is None else len(state[1]),
+            'stale': state is not None and now >= state[2],
+            'expires_in': None if state is None else state[2] - now,
+            'breaker': self.breaker.state,
+            'failures': self.breaker.failures
+        }
+
+    def clear(self):
+        '''
+        Discards the cached key set so the next request fetches it again.
+        '''
+        self._state = None
+        self._last_forced = 0.0
@@ -0,0 +1,133 @@
+'''
+Mints RS256 tokens signed by a local key for load testing and CI.
+
+The tokens are accepted by requires_auth when the server is started with
+JWKS_FILE pointing at the key set written by the 'keys' command, so the
+protected endpoints can be exercised without Auth0 or a network.
+
+EXAMPLE (from the backend directory)
+    python -m src.auth.mint keys --private-key private.pem --jwks jwks.json
+    python -m src.auth.mint token --private-key private.pem \
+        --permissions get:drinks-detail post:drinks
+'''
+import argparse
+import json
+import os
+import time
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+from jose.utils import base64url_encode
+
+DEFAULT_KID = 'local-test-key'
+DEFAULT_DOMAIN = os.getenv('AUTH0_DOMAIN', 'johnatborpa.au.auth0.com')
+DEFAULT_AUDIENCE = os.getenv('API_AUDIENCE', 'coffeeshop')
+ALL_PERMISSIONS = ['get:drinks-detail', 'post:drinks', 'patch:drinks',
+                   'delete:drinks']
+
+
+def encode_int(value):
+    '''
+    Encodes an integer as the base64url string used in a JWK.
+    '''
+    length = (value.bit_length() + 7) // 8
+    return base64url_encode(value.to_bytes(length, 'big')).decode('ascii')
+
+
+def generate_key_pair(kid=DEFAULT_KID, bits=2048):
+    '''
+    Generates an RSA key pair.
+
+    @INPUTS
+        kid: the key id to publish the public key under
+        bits: the size of the key
+
+    Returns a tuple of the PEM encoded private key and a JSON Web Key Set
+    containing the public key.
+    '''
+    key = RSA.generate(bits)
+    jwks = {
+        'keys': [{
+            'kty': 'RSA',
+            'kid': kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': encode_int(key.n),
+            'e': encode_int(key.e)
+        }]
+    }
+    return key.exportKey('PEM').decode('ascii'), jwks
+
+
+def mint_token(private_key, permissions=None, audience=DEFAULT_AUDIENCE,
+               issuer=None, expires_in=3600, subject='load-test|1',
+               kid=DEFAULT_KID, claims=None):
+    '''
+    Mints a signed RS256 token.
+
+    @INPUTS
+        private_key: the PEM encoded private key
+        permissions: list of permission strings (i.e. ['post:drinks'])
+        audience: the aud claim
+        issuer: the iss claim, defaults to the configured Auth0 domain
+        expires_in: seconds from now until the exp claim
+        subject: the sub claim
+        kid: the key id to put in the token header
+        claims: a dict of any extra claims
+
+    Returns the token (string)
+    '''
+    now = int(time.time())
+    payload = {
+        'iss': issuer or 'https://' + DEFAULT_DOMAIN + '/',
+        'sub': subject,
+        'aud': audience,
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': list(permissions or [])
+    }
+    payload.update(claims or {})
+    return jwt.encode(payload, private_key, algorithm='RS256',
+                      headers={'kid': kid})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command')
+
+    keys = commands.add_parser('keys', help='generate a signing key pair')
+    keys.add_argument('--private-key', default='private.pem')
+    keys.add_argument('--jwks', default='jwks.json')
+    keys.add_argument('--kid', default=DEFAULT_KID)
+
+    token = commands.add_parser('token', help='mint a token')
+    token.add_argument('--private-key', default='private.pem')
+    token.add_argument('--kid', default=DEFAULT_KID)
+    token.add_argument('--permissions', nargs='*', default=ALL_PERMISSIONS)
+    token.add_argument('--aud', default=DEFAULT_AUDIENCE)
+    token.add_argument('--iss', default=None)
+    token.add_argument('--sub', default='load-test|1')
+    token.add_argument('--exp', type=int, default=3600,
+                       help='seconds until the token expires')
+
+    args = parser.parse_args(argv)
+    if args.command == 'keys':
+        private_key, jwks = generate_key_pair(args.kid)
+        with open(args.private_key, 'w') as key_file:
+            key_file.write(private_key)
+        with open(args.jwks, 'w') as jwks_file:
+            json.dump(jwks, jwks_file, indent=2)
+        print('Wrote ' + args.private_key + ' and ' + args.jwks)
+    elif args.command == 'token':
+        with open(args.private_key) as key_file:
+            private_key = key_file.read()
+        print(mint_token(private_key, permissions=args.permissions,
+                         audience=args.aud, issuer=args.iss,
+                         expires_in=args.exp, subject=args.sub,
+                         kid=args.kid))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
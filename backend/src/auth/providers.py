@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import re
+from urllib.request import urlopen
+
+# Get the logger specified in the file
+logger = logging.getLogger(__name__)
+
+MAX_AGE_PATTERN = re.compile(r'max-age\s*=\s*(\d+)', re.IGNORECASE)
+
+
+def parse_max_age(cache_control, default):
+    '''
+    Gets the number of seconds a response may be cached for.
+
+    @INPUTS
+        cache_control: the value of a Cache-Control header (or None)
+        default: the number of seconds to use if no max-age is given
+
+    Returns 0 for no-store/no-cache, the max-age if one is present,
+    otherwise the default. JWKSCache keeps a key set for at least its
+    min_refresh_interval whatever this returns.
+    '''
+    if not cache_control:
+        return default
+    lowered = cache_control.lower()
+    if 'no-store' in lowered or 'no-cache' in lowered:
+        return 0
+    match = MAX_AGE_PATTERN.search(cache_control)
+    if match is None:
+        return default
+    return int(match.group(1))
+
+
+class KeyProvider:
+    '''
+    KeyProvider - the source of the JSON Web Key Set used to verify tokens.
+
+    Subclasses implement fetch() which returns a tuple of the decoded key
+    set and the number of seconds it may be cached for.
+    '''
+    def fetch(self):
+        raise NotImplementedError
+
+
+class UrlKeyProvider(KeyProvider):
+    '''
+    UrlKeyProvider - downloads the key set from the identity provider.
+
+    The lifetime is taken from the Cache-Control max-age of the response,
+    falling back to default_ttl and capped at max_ttl.
+    '''
+    def __init__(self, url, timeout=5.0, default_ttl=600, max_ttl=86400):
+        self.url = url
+        self.timeout = timeout
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+
+    def fetch(self):
+        logger.debug('Fetching JWKS from %s', self.url)
+        response = urlopen(self.url, timeout=self.timeout)
+        jwks = json.loads(response.read())
+        ttl = parse_max_age(response.headers.get('Cache-Control'),
+                            self.default_ttl)
+        return jwks, min(ttl, self.max_ttl)
+
+
+class FileKeyProvider(KeyProvider):
+    '''
+    FileKeyProvider - reads the key set from a local json file.
+
+    Used for load testing and CI where there is no identity provider.
+    The file is read again every ttl seconds so it can be replaced
+    while the server is running.
+    '''
+    def __init__(self, path, ttl=600):
+        self.path = path
+        self.ttl = ttl
+
+    def fetch(self):
+        logger.debug('Reading JWKS from %s', self.path)
+        with open(self.path) as jwks_file:
+            return json.load(jwks_file), self.ttl
+
+
+class StaticKeyProvider(KeyProvider):
+    '''
+    StaticKeyProvider - serves a key set held in memory.
+    '''
+    def __init__(self, jwks, ttl=86400):
+        self.jwks = jwks
+        self.ttl = ttl
+
+    def fetch(self):
+        return self.jwks, self.ttl
+
+
+def key_provider_from_env(domain, timeout=5.0, default_ttl=600):
+    '''
+    Chooses the key provider for the configured environment.
+
+    @INPUTS
+        domain: the Auth0 domain to download the key set from
+        timeout: the download timeout in seconds
+        default_ttl: the lifetime of a key set without a max-age
+
+    Returns a FileKeyProvider if JWKS_FILE is set, otherwise a
+    UrlKeyProvider for the domain's /.well-known/jwks.json.
+    '''
+    jwks_file = os.getenv('JWKS_FILE')
+    if jwks_file:
+        return FileKeyProvider(jwks_file, ttl=default_ttl)
+    return UrlKeyProvider(f'https://{domain}/.well-known/jwks.json',
+                          timeout=timeout, default_ttl=default_ttl)
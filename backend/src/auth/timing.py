@@ -0,0 +1,78 @@
+import bisect
+import threading
+
+# upper bounds of the histogram buckets in milliseconds
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250,
+                   500, 1000, 2500)
+
+
+class Histogram:
+    '''
+    Histogram - counts durations into fixed millisecond buckets.
+
+    The last bucket counts everything above the largest bound.
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, milliseconds):
+        self.counts[bisect.bisect_left(self.buckets, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        if milliseconds > self.max:
+            self.max = milliseconds
+
+    def to_dict(self):
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        return {
+            'count': self.count,
+            'sum_ms': self.total,
+            'mean_ms': self.total / self.count if self.count else 0.0,
+            'max_ms': self.max,
+            'buckets': dict(zip(bounds, self.counts))
+        }
+
+
+class AuthMetrics:
+    '''
+    AuthMetrics - per-phase timing histograms for requires_auth.
+
+    The phases are recorded only when enabled is True. Callers check
+    enabled before reading the clock so that there is no cost other
+    than an attribute lookup when timing is switched off.
+    '''
+    def __init__(self, enabled=False, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def record(self, phase, seconds):
+        '''
+        Records the duration of a phase.
+
+        @INPUTS
+            phase: the name of the phase (i.e. 'decode')
+            seconds: the duration in seconds
+        '''
+        with self._lock:
+            histogram = self._histograms.get(phase)
+            if histogram is None:
+                histogram = self._histograms[phase] = Histogram(self.buckets)
+            histogram.observe(seconds * 1000.0)
+
+    def snapshot(self):
+        '''
+        Returns a dict of phase name to histogram summary.
+        '''
+        with self._lock:
+            return {phase: histogram.to_dict()
+                    for phase, histogram in self._histograms.items()}
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
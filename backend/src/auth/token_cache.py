@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+# Get the logger specified in the file
+logger = logging.getLogger(__name__)
+
+
+def token_digest(token):
+    '''
+    Returns a fixed size digest of a token to use as a cache key.
+
+    The digest is used instead of the token itself so the cache never
+    holds the bearer credentials.
+    '''
+    if isinstance(token, str):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).digest()
+
+
+class TokenCache:
+    '''
+    TokenCache - a bounded LRU cache of verified JWT payloads.
+
+    Entries are keyed by the token digest and are only returned until the
+    token's exp claim, so a cached token expires exactly when the token
+    itself would have failed verification.
+
+    The payloads are shared between requests and must not be modified.
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, token):
+        '''
+        Gets the verified payload for a token.
+
+        @INPUTS
+            token: a json web token (string)
+
+        Returns the payload or None if the token is not cached or has
+        expired.
+        '''
+        if self.maxsize <= 0:
+            return None
+        key = token_digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, payload = entry
+                if time.time() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, payload):
+        '''
+        Stores the verified payload for a token until its exp claim.
+
+        @INPUTS
+            token: a json web token (string)
+            payload: the decoded and verified payload
+
+        Tokens without an exp claim are not cached.
+        '''
+        if self.maxsize <= 0:
+            return
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)):
+            return
+        self._store(token, expires_at, payload)
+
+    def _store(self, token, expires_at, value):
+        key = token_digest(token)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        '''
+        Discards all of the cached payloads.
+        '''
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''
+        Returns a dict of the cache size and hit/miss counters.
+        '''
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class RejectedTokenCache(TokenCache):
+    '''
+    RejectedTokenCache - a short lived cache of tokens that failed
+    verification.
+
+    The AuthError details are kept for ttl seconds so that a client
+    repeating a bad token gets the same error again without the token
+    being parsed, looked up in the key set or decoded.
+    '''
+    def __init__(self, maxsize=4096, ttl=60):
+        super().__init__(maxsize=maxsize)
+        self.ttl = ttl
+
+    def put(self, token, error, status_code):
+        '''
+        Remembers that a token was rejected.
+
+        @INPUTS
+            token: a json web token (string)
+            error: the AuthError error dict
+            status_code: the AuthError status code
+        '''
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        self._store(token, time.time() + self.ttl, (error, status_code))
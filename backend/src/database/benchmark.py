@@ -0,0 +1,90 @@
+'''
+Compares the per-row cost of reading the menu through the ORM with the
+Core select used by the list endpoints (load_drink_records).
+
+A throwaway in-memory SQLite database is filled with drinks and each read
+path loads the whole table and builds the long form of every drink, which
+is the work done by GET /drinks-detail.
+
+EXAMPLE (from the backend directory)
+    python -m src.database.benchmark --drinks 5000 --repeat 20
+'''
+import argparse
+import json
+import time
+
+from flask import Flask
+
+from .models import Drink, db, load_drink_records, recipe_cache
+
+
+def setup_benchmark_db(drinks):
+    '''
+    Creates a Flask application bound to an in-memory database holding
+    the given number of drinks.
+    '''
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.app = app
+    db.init_app(app)
+    db.create_all()
+    recipe = json.dumps([{'name': 'coffee', 'color': 'black', 'parts': 1},
+                         {'name': 'milk', 'color': 'white', 'parts': 3}])
+    db.session.execute(Drink.__table__.insert(), [
+        {'title': 'Drink ' + str(number), 'recipe': recipe, 'version': 0}
+        for number in range(drinks)])
+    db.session.commit()
+    return app
+
+
+def time_read(read, repeat):
+    '''
+    Returns the best time in seconds of repeat runs of read.
+
+    The session is cleared before each run so that every run starts with
+    an empty identity map, as a request does.
+    '''
+    best = None
+    for _ in range(repeat):
+        db.session.remove()
+        start = time.perf_counter()
+        read()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--drinks', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    setup_benchmark_db(args.drinks)
+
+    def read_orm():
+        return [drink.long() for drink in Drink.query.order_by(Drink.id)]
+
+    def read_records():
+        return [record.long() for record in load_drink_records()]
+
+    # size and warm the parsed recipe cache as the menu snapshot does, so
+    # both paths measure the read rather than json parsing
+    recipe_cache.fit(args.drinks)
+    read_records()
+    results = [('orm', time_read(read_orm, args.repeat)),
+               ('records', time_read(read_records, args.repeat))]
+    print(str(args.drinks) + ' drinks, best of ' + str(args.repeat) +
+          ' runs (recipe cache size ' +
+          str(recipe_cache.maxsize) + ')')
+    for name, seconds in results:
+        print('  {:<8} {:8.2f} ms  {:6.2f} us/row'.format(
+            name, seconds * 1000, seconds * 1e6 / args.drinks))
+    print('  saving   {:6.2f} us/row'.format(
+        (results[0][1] - results[1][1]) * 1e6 / args.drinks))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import exc
+
+from .models import db, notify_menu_changed
+
+# Get the logger specified in the file
+logger = logging.getLogger(__name__)
+
+
+class PendingWrite:
+    '''
+    PendingWrite - one write waiting for the next group commit.
+    '''
+    __slots__ = ('stage', 'done', 'change', 'error')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.done = threading.Event()
+        self.change = None
+        self.error = None
+
+
+class WriteCoalescer:
+    '''
+    WriteCoalescer - commits the drink writes of concurrent requests
+    together.
+
+    Each request submits a stage function (i.e. a call of one of the Drink
+    stage methods) and waits. A background thread collects the writes that
+    arrive within window seconds of the first one, up to max_batch of
+    them, applies them in order in one transaction and commits once, so
+    a burst of writes pays for one commit (and one fsync) rather than one
+    each. Every request is then released with its own change or error.
+
+    A write that fails with an IntegrityError (a duplicate title) only
+    fails that request, because the Drink stage methods run the statement
+    that can conflict before any other and a failed statement is undone
+    on its own. Any other error, or a failed commit, fails every write in
+    the group.
+    '''
+    def __init__(self, app, window=0.005, max_batch=100):
+        self.app = app
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self._queue = []
+        self._condition = threading.Condition()
+        self._thread_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        '''
+        Starts the background commit thread if it is not running.
+        '''
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run,
+                                            name='write-coalescer',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the background commit thread once the queued writes have
+        been committed.
+        '''
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def submit(self, stage):
+        '''
+        Applies a write in the next group commit.
+
+        @INPUTS
+            stage: a function that makes the write in the current
+                transaction without committing and returns the change dict
+                (or None if there was nothing to change)
+
+        Raises the error of the write or of the commit.
+
+        Returns the change dict once it has been committed.
+        '''
+        self.start()
+        write = PendingWrite(stage)
+        with self._condition:
+            self._queue.append(write)
+            self._condition.notify_all()
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.change
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._queue and not self._stopped:
+                self._condition.wait()
+            deadline = time.monotonic() + self.window
+            while len(self._queue) < self.max_batch and not self._stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._queue[:self.max_batch]
+            del self._queue[:self.max_batch]
+            return batch
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    return
+                try:
+                    self._commit(batch)
+                except Exception as e:
+                    # keep the thread alive for the writes still to come
+                    logger.exception('Group commit failed: %s', e)
+                    for write in batch:
+                        write.error = write.error or e
+                finally:
+                    db.session.remove()
+                    for write in batch:
+                        write.done.set()
+
+    def _commit(self, batch):
+        try:
+            for write in batch:
+                try:
+                    write.change = write.stage()
+                except exc.IntegrityError as e:
+                    write.error = e
+            db.session.commit()
+        except Exception as e:
+            logger.error('Group commit of %d writes failed: %s',
+                         len(batch), e)
+            db.session.rollback()
+            for write in batch:
+                write.change = None
+                write.error = write.error or e
+            return
+        logger.debug('Group committed %d writes', len(batch))
+        for write in batch:
+            if write.change is not None:
+                notify_menu_changed(write.change)
@@ -0,0 +1,142 @@
+import json
+import logging
+import threading
+
+from flask import g, has_app_context
+
+from .models import (get_menu_version, load_drink_records,
+                     menu_change_listeners, recipe_cache)
+
+# Get the logger specified in the file
+logger = logging.getLogger(__name__)
+
+
+def encode_drinks(drinks):
+    '''
+    Encodes a drinks list response the way jsonify does.
+
+    Returns the json as bytes.
+    '''
+    return json.dumps({
+        'success': True,
+        'drinks': drinks
+    }, separators=(',', ':'), sort_keys=True).encode('utf-8') + b'\n'
+
+
+class MenuSnapshot:
+    '''
+    MenuSnapshot - an immutable copy of the menu ready to be served.
+
+    Holds the drink.short() and drink.long() representations of every
+    drink and the json responses for GET /drinks and GET /drinks-detail
+    already encoded, and the menu version it was built at.
+
+    The two forms are built independently. A drink whose recipe has no
+    short form leaves short and short_json as None (GET /drinks fails)
+    but the long form is still served.
+    '''
+    __slots__ = ('version', 'count', 'short', 'long', 'short_json',
+                 'long_json')
+
+    def __init__(self, drinks, version):
+        long = tuple(drink.long() for drink in drinks)
+        try:
+            short = tuple(drink.short() for drink in drinks)
+        except Exception as e:
+            logger.error('Cannot build the short form of the menu: %r', e)
+            short = None
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'count', len(long))
+        object.__setattr__(self, 'short', short)
+        object.__setattr__(self, 'long', long)
+        object.__setattr__(self, 'short_json',
+                           encode_drinks(short) if short is not None else None)
+        object.__setattr__(self, 'long_json', encode_drinks(long))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('MenuSnapshot is immutable')
+
+
+class MenuCache:
+    '''
+    MenuCache - holds the current MenuSnapshot.
+
+    Reading the menu is a single attribute read. A committed insert,
+    update or delete of a Drink discards the snapshot (copy on write) and
+    the next read builds a new one from the database and swaps it in.
+    A snapshot built from data read before a later write is never
+    installed, so a write is always visible to reads that follow it.
+
+    Writes made by other worker processes are picked up through the menu
+    version in the database (see models.MenuVersion). The version is read
+    at most once per request and a snapshot built at another version is
+    discarded.
+    '''
+    def __init__(self):
+        self._snapshot = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self, change=None):
+        '''
+        Discards the current snapshot.
+
+        Registered as a menu change listener (see models.notify_menu_changed)
+        so the change that caused it is passed in, but it is not needed.
+        '''
+        with self._lock:
+            self._generation += 1
+            self._snapshot = None
+        if has_app_context():
+            # this request's writes changed the version
+            g.pop('menu_version', None)
+
+    def sync(self):
+        '''
+        Reads the menu version and discards the snapshot if another worker
+        has changed the menu since it was built.
+
+        Returns the menu version.
+        '''
+        version = get_menu_version()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version != version:
+            logger.debug('Menu version changed to %s', version)
+            self.invalidate()
+        return version
+
+    def current_version(self):
+        '''
+        Returns the menu version, reading it from the database only the
+        first time it is asked for in a request.
+        '''
+        if not has_app_context():
+            return self.sync()
+        version = g.get('menu_version')
+        if version is None:
+            version = g.menu_version = self.sync()
+        return version
+
+    def get(self):
+        '''
+        Returns the current MenuSnapshot, building it if needed.
+        '''
+        version = self.current_version()
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+
+        generation = self._generation
+        logger.debug('Building the menu snapshot')
+        drinks = load_drink_records()
+        # keep every recipe of the menu parsed (see RecipeCache)
+        recipe_cache.fit(len(drinks))
+        snapshot = MenuSnapshot(drinks, version)
+        with self._lock:
+            if generation == self._generation:
+                self._snapshot = snapshot
+        return snapshot
+
+
+menu_cache = MenuCache()
+menu_change_listeners.append(menu_cache.invalidate)
@@ -1,5 +1,9 @@
+import logging
 import os
-from sqlalchemy import Column, String, Integer
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import Column, String, Integer, select
 from flask_sqlalchemy import SQLAlchemy
 import json
 
@@ -9,6 +13,41 @@ database_path = "sqlite:///{}".format(os.path.join(project_dir, database_filenam
 
 db = SQLAlchemy()
 
+# Get the logger specified in the file
+logger = logging.getLogger(__name__)
+
+# the least number of drinks whose parsed recipes are kept for the whole
+# process, the cache grows to the number of drinks
+RECIPE_CACHE_SIZE = int(os.getenv('RECIPE_CACHE_SIZE', '1024'))
+
+# the number of deleted drink ids kept for GET /drinks/changes
+MAX_TOMBSTONES = int(os.getenv('MAX_TOMBSTONES', '1000'))
+
+# functions called after a drink is inserted, updated or deleted
+menu_change_listeners = []
+
+
+def notify_menu_changed(change=None):
+    '''
+    Tells the menu_change_listeners that the drinks table has changed.
+
+    @INPUTS
+        change: a dict describing the change or None if the whole table
+            has changed. The dict has the 'type' ('created', 'updated' or
+            'deleted'), the drink 'id', the menu 'version' and the 'drink'
+            itself (None once it is deleted).
+
+    Called after every committed insert, update or delete of a Drink. The
+    change is already committed, so an error raised by a listener is
+    logged and the remaining listeners are still called.
+    '''
+    for listener in menu_change_listeners:
+        try:
+            listener(change)
+        except Exception as e:
+            logger.exception('Menu change listener %r failed: %s',
+                             listener, e)
+
 
 def setup_db(app):
     '''
@@ -33,6 +72,15 @@ def db_drop_and_create_all():
     '''
     db.drop_all()
     db.create_all()
+    # start the menu version from the clock so that it never repeats a
+    # version used before the database was recreated, changes before it
+    # are unknown so it is also the tombstone horizon
+    start_version = int(time.time() * 1000)
+    db.session.add(MenuVersion(id=1, version=start_version,
+                               tombstone_horizon=start_version,
+                               drink_count=0))
+    db.session.commit()
+    notify_menu_changed()
 
     # insert a dummy drink for testing
     drink = Drink(
@@ -41,6 +89,358 @@ def db_drop_and_create_all():
     )
     drink.insert()
 
+
+def bump_menu_version(count_change=0):
+    '''
+    Increments the menu version in the current transaction.
+
+    @INPUTS
+        count_change: added to the drink count (1 for an insert, -1 for a
+            delete)
+
+    Called by the Drink write methods in the transaction that changes the
+    drinks table so the new version and drink count are committed with
+    the change.
+
+    Returns the new version, which the changed row is stamped with.
+    '''
+    table = MenuVersion.__table__
+    db.session.execute(table.update().values(
+        version=table.c.version + 1,
+        drink_count=table.c.drink_count + count_change))
+    return get_menu_version()
+
+
+def next_menu_version():
+    '''
+    Returns a scalar subquery of the version the next bump_menu_version in
+    this transaction will return, to stamp a changed row with in the same
+    statement that changes it.
+    '''
+    return select([MenuVersion.__table__.c.version + 1]).as_scalar()
+
+
+def get_menu_version():
+    '''
+    Returns the current menu version from the database.
+
+    Every worker process sees the same version, so a worker can tell that
+    another worker has changed the drinks table since it last looked.
+    '''
+    return db.session.execute(
+        MenuVersion.__table__.select().with_only_columns(
+            [MenuVersion.__table__.c.version])).scalar()
+
+
+def get_drink_count():
+    '''
+    Returns the number of drinks from the maintained counter, without
+    counting the rows of the drinks table.
+    '''
+    return db.session.execute(
+        MenuVersion.__table__.select().with_only_columns(
+            [MenuVersion.__table__.c.drink_count])).scalar()
+
+
+def select_drink_records(where=None, limit=None):
+    '''
+    Builds a Core select of the DrinkRecord columns in id order.
+    '''
+    table = Drink.__table__
+    query = select([table.c.id, table.c.title, table.c.recipe]) \
+        .order_by(table.c.id)
+    if where is not None:
+        query = query.where(where)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def load_drink_records(where=None, limit=None):
+    '''
+    Gets drinks as DrinkRecords, in id order.
+
+    @INPUTS
+        where: an optional Core filter on the drinks table
+        limit: the maximum number of drinks to return
+
+    Only the id, title and recipe columns are read and no ORM objects
+    are built or added to the session.
+    '''
+    result = db.session.execute(select_drink_records(where, limit))
+    return [DrinkRecord(*row) for row in result]
+
+
+def drinks_after(after_id, limit):
+    '''
+    Gets a page of drinks in id order.
+
+    @INPUTS
+        after_id: only drinks with a greater id are returned (the cursor)
+        limit: the maximum number of drinks to return
+
+    Uses the primary key index so a page costs the same wherever it is.
+
+    Returns a list of DrinkRecords.
+    '''
+    return load_drink_records(Drink.__table__.c.id > after_id, limit)
+
+
+def iter_drinks(batch_size):
+    '''
+    Iterates over all of the drinks in id order as DrinkRecords.
+
+    @INPUTS
+        batch_size: the number of rows read by each query
+
+    Each batch is its own keyset query (see drinks_after) that is read to
+    the end before any of its rows are returned. No cursor is left open
+    while the caller (i.e. a streamed response waiting on a slow client)
+    holds the iterator, so the read lock is not held and writers are not
+    blocked. Only the current batch is held in memory. Drinks written
+    while iterating are seen if their id has not been passed yet.
+    '''
+    after_id = 0
+    while True:
+        batch = drinks_after(after_id, batch_size)
+        for record in batch:
+            yield record
+        if len(batch) < batch_size:
+            return
+        after_id = batch[-1].id
+
+
+def compact_tombstones():
+    '''
+    Keeps only the newest MAX_TOMBSTONES tombstones.
+
+    Called by Drink.delete and Drink.stage_delete in the same transaction
+    as the new tombstone.
+    The tombstone horizon is moved up to the newest version dropped, so a
+    client asking for changes from before it is told to reload the menu.
+    '''
+    table = DrinkTombstone.__table__
+    cutoff = db.session.execute(
+        select([table.c.version]).order_by(table.c.version.desc())
+        .offset(MAX_TOMBSTONES).limit(1)).scalar()
+    if cutoff is None:
+        return
+    db.session.execute(table.delete().where(table.c.version <= cutoff))
+    version_table = MenuVersion.__table__
+    db.session.execute(version_table.update()
+                       .where(version_table.c.tombstone_horizon < cutoff)
+                       .values(tombstone_horizon=cutoff))
+
+
+def drink_changes_since(since):
+    '''
+    Gets the changes to the drinks table after a menu version.
+
+    @INPUTS
+        since: the menu version the client already has
+
+    The menu version is read first, so anything changed while the changes
+    are being read is returned again by the next call (applying a change
+    twice does no harm).
+
+    Returns a tuple of (version, reset, drinks, deleted_ids) where version
+    is the menu version to ask from next time, drinks are DrinkRecords of
+    the inserted or updated drinks and deleted_ids are the ids of deleted
+    drinks. reset is True if since is older than the tombstone horizon, in
+    which case drinks is the whole menu and the client must drop any drink
+    not in it.
+    '''
+    menu_version = MenuVersion.query.get(1)
+    version = menu_version.version
+    if since < menu_version.tombstone_horizon:
+        return version, True, load_drink_records(), []
+
+    drinks = load_drink_records(Drink.__table__.c.version > since)
+    deleted_ids = [tombstone.drink_id for tombstone in
+                   DrinkTombstone.query.filter(DrinkTombstone.version > since)
+                   .order_by(DrinkTombstone.version)]
+    return version, False, drinks, deleted_ids
+
+
+def existing_titles(titles, batch_size=500):
+    '''
+    Finds which of a list of titles are already in the drinks table.
+
+    @INPUTS
+        titles: the titles to look for
+        batch_size: the most titles looked up by one query (SQLite limits
+            the number of bound parameters in a statement)
+
+    Returns the set of titles that are already taken.
+    '''
+    title = Drink.__table__.c.title
+    taken = set()
+    for start in range(0, len(titles), batch_size):
+        batch = titles[start:start + batch_size]
+        taken.update(row[0] for row in db.session.execute(
+            select([title]).where(title.in_(batch))))
+    return taken
+
+
+def short_recipe(long_recipe):
+    '''
+    Returns the short form of a parsed recipe, the color and parts of each
+    ingredient.
+    '''
+    return [{'color': r['color'], 'parts': r['parts']} for r in long_recipe]
+
+
+class RecipeCache:
+    '''
+    RecipeCache - the parsed recipes of the most recently used drinks.
+
+    Entries are kept for the whole process, keyed by the drink id together
+    with the recipe text they were parsed from, so a changed recipe is
+    parsed again and an unchanged one is shared by every request. The long
+    form is only json.loads of the recipe. The short form is derived from
+    it when it is first asked for, so a recipe that has no short form
+    (i.e. one that is not a list of ingredients) still has a long form.
+
+    The menu snapshot reads every drink in id order, which misses every
+    time in an LRU cache smaller than the menu, so the snapshot grows the
+    cache to the number of drinks (see fit) and maxsize is only the
+    smallest size. Streamed lists read recipes without storing them
+    (store=False) so their memory does not grow with the menu.
+
+    The returned recipes are shared and must not be modified.
+    '''
+    def __init__(self, maxsize=1024):
+        self.min_size = maxsize
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def fit(self, drink_count):
+        '''
+        Makes the cache big enough to hold every drink.
+        '''
+        self.maxsize = max(self.min_size, drink_count)
+
+    def _entry(self, drink_id, recipe, store):
+        with self._lock:
+            entry = self._entries.get(drink_id)
+            if entry is not None and (entry[0] is recipe or
+                                      entry[0] == recipe):
+                self._entries.move_to_end(drink_id)
+                return entry
+        # [recipe text, long form, short form (None until asked for)]
+        entry = [recipe, json.loads(recipe), None]
+        if not store:
+            return entry
+        with self._lock:
+            self._entries[drink_id] = entry
+            self._entries.move_to_end(drink_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def long(self, drink_id, recipe, store=True):
+        '''
+        Returns the long form of a drink's recipe.
+
+        @INPUTS
+            drink_id: the id of the drink the recipe belongs to
+            recipe: the json recipe blob
+            store: False to parse a recipe that is not cached without
+                adding it to the cache
+        '''
+        return self._entry(drink_id, recipe, store)[1]
+
+    def short(self, drink_id, recipe, store=True):
+        '''
+        Returns the short form of a drink's recipe.
+
+        @INPUTS
+            drink_id: the id of the drink the recipe belongs to
+            recipe: the json recipe blob
+            store: False to parse a recipe that is not cached without
+                adding it to the cache
+
+        Raises an error if the recipe is not a list of ingredients with a
+        color and parts.
+        '''
+        entry = self._entry(drink_id, recipe, store)
+        if entry[2] is None:
+            entry[2] = short_recipe(entry[1])
+        return entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+recipe_cache = RecipeCache(RECIPE_CACHE_SIZE)
+
+
+def commit_without_expiring():
+    '''
+    Commits the session without expiring the loaded models.
+
+    By default a commit expires every attribute, so reading a model that
+    was just written (i.e. drink.long() for the response) runs a SELECT
+    to load back the values that were written. Used by Drink.insert and
+    Drink.update, whose attributes are all set in Python and are
+    therefore already known after the flush.
+    '''
+    session = db.session()
+    expire_on_commit = session.expire_on_commit
+    session.expire_on_commit = False
+    try:
+        session.commit()
+    finally:
+        session.expire_on_commit = expire_on_commit
+
+
+def commit_changes(changes):
+    '''
+    Commits the current transaction and then tells the menu change
+    listeners about each of the changes made in it.
+
+    @INPUTS
+        changes: a list of the change dicts returned by the Drink stage
+            methods
+    '''
+    db.session.commit()
+    for change in changes:
+        notify_menu_changed(change)
+
+
+def commit_write(stage):
+    '''
+    Applies a write in its own transaction.
+
+    @INPUTS
+        stage: a function that makes the write in the current transaction
+            without committing and returns the change dict (or None if
+            there was nothing to change), i.e. one of the Drink stage
+            methods
+
+    Returns the change dict once it has been committed, or None.
+    '''
+    change = stage()
+    if change is None:
+        db.session.rollback()
+        return None
+    commit_changes([change])
+    return change
+
+
+def title_taken(title, drink_id=None):
+    '''
+    Returns True if a drink other than drink_id already has the title.
+    '''
+    table = Drink.__table__
+    query = select([table.c.id]).where(table.c.title == title)
+    if drink_id is not None:
+        query = query.where(table.c.id != drink_id)
+    return db.session.execute(query.limit(1)).first() is not None
+
+
 def db_rollback():
     '''
     Rollbacks the database in the event of an error while updating/deleting
@@ -48,6 +448,34 @@ def db_rollback():
     db.session.rollback()
 
 
+class MenuVersion(db.Model):
+    '''
+    MenuVersion - a single row holding the menu version.
+
+    The version is incremented (and the drink count maintained) in the
+    same transaction as every insert, update or delete of a Drink.
+    '''
+    __tablename__ = 'menu_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    # changes at or before this version may have had their tombstones removed
+    tombstone_horizon = Column(Integer, nullable=False, default=0)
+    # the number of rows in the drinks table
+    drink_count = Column(Integer, nullable=False, default=0)
+
+
+class DrinkTombstone(db.Model):
+    '''
+    DrinkTombstone - records the menu version a drink was deleted at.
+
+    Used by GET /drinks/changes to tell clients about deleted drinks.
+    '''
+    __tablename__ = 'drink_tombstone'
+    id = Column(Integer, primary_key=True)
+    drink_id = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False, index=True)
+
+
 class Drink(db.Model):
     '''
     Drink - a persistent drink entity, extends the base SQLAlchemy Model.
@@ -59,18 +487,18 @@ class Drink(db.Model):
     # the ingredients blob - this stores a lazy json blob
     # the required datatype is [{'color': string, 'name':string, 'parts':number}]
     recipe =  Column(String(180), nullable=False)
+    # the menu version of the last insert or update of this drink
+    version = Column(Integer, nullable=False, default=0, index=True)
 
 
     def short(self):
         '''
         Short form representation of the Drink model
         '''
-        # print(json.loads(self.recipe))
-        short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in json.loads(self.recipe)]
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': short_recipe
+            'recipe': recipe_cache.short(self.id, self.recipe)
         }
 
     def long(self):
@@ -80,7 +508,7 @@ class Drink(db.Model):
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': json.loads(self.recipe)
+            'recipe': recipe_cache.long(self.id, self.recipe)
         }
 
 
@@ -88,7 +516,8 @@ class Drink(db.Model):
         '''
         Inserts a new model into a database.
 
-        The model must have a unique name.
+        The model must have a unique name, a duplicate raises an
+        IntegrityError from the commit and the caller must roll back.
 
         The model must have a unique id or null id
 
@@ -97,7 +526,10 @@ class Drink(db.Model):
             drink.insert()
         '''
         db.session.add(self)
-        db.session.commit()
+        self.version = bump_menu_version(1)
+        commit_without_expiring()
+        notify_menu_changed({'type': 'created', 'id': self.id,
+                             'version': self.version, 'drink': self})
 
 
     def delete(self):
@@ -110,8 +542,14 @@ class Drink(db.Model):
             drink = Drink(title=req_title, recipe=req_recipe)
             drink.delete()
         '''
+        drink_id = self.id
+        version = bump_menu_version(-1)
         db.session.delete(self)
+        db.session.add(DrinkTombstone(drink_id=drink_id, version=version))
+        compact_tombstones()
         db.session.commit()
+        notify_menu_changed({'type': 'deleted', 'id': drink_id,
+                             'version': version, 'drink': None})
 
 
     def update(self):
@@ -125,8 +563,228 @@ class Drink(db.Model):
             drink.title = 'Black Coffee'
             drink.update()
         '''
+        self.version = bump_menu_version()
+        commit_without_expiring()
+        notify_menu_changed({'type': 'updated', 'id': self.id,
+                             'version': self.version, 'drink': self})
+
+
+    @classmethod
+    def bulk_insert(cls, drinks, batch_size=500):
+        '''
+        Inserts many new drinks in one transaction.
+
+        @INPUTS
+            drinks: a list of (title, recipe) tuples, recipe is the json
+                recipe string
+            batch_size: the number of rows sent by each executemany
+
+        All of the drinks are stamped with one new menu version and
+        inserted with executemany rather than one INSERT per drink. A
+        title that is already taken raises an IntegrityError, nothing is
+        inserted and the caller must roll back. The menu change listeners
+        are told to reload the menu rather than sent one change per drink.
+
+        Returns a list of DrinkRecords of the new drinks, in the order
+        they were given.
+
+        EXAMPLE
+            records = Drink.bulk_insert([('Mocha', recipe_json)])
+        '''
+        table = cls.__table__
+        version = bump_menu_version(len(drinks))
+        rows = [{'title': title, 'recipe': recipe, 'version': version}
+                for title, recipe in drinks]
+        for start in range(0, len(rows), batch_size):
+            db.session.execute(table.insert(), rows[start:start + batch_size])
+        # executemany does not report the new ids, so they are read back
+        # by title before the commit
+        records = {}
+        titles = [title for title, recipe in drinks]
+        for start in range(0, len(titles), batch_size):
+            for record in load_drink_records(
+                    table.c.title.in_(titles[start:start + batch_size])):
+                records[record.title] = record
         db.session.commit()
+        notify_menu_changed()
+        return [records[title] for title in titles]
+
+    @classmethod
+    def stage_create(cls, title, recipe):
+        '''
+        Inserts a new drink in the current transaction without committing.
+
+        @INPUTS
+            title: the title of the new drink
+            recipe: the recipe json string
+
+        A duplicate title raises an IntegrityError and the caller must
+        roll back.
+
+        Returns the change dict to pass to notify_menu_changed once the
+        transaction is committed.
+        '''
+        table = cls.__table__
+        result = db.session.execute(table.insert().values(
+            title=title, recipe=recipe, version=next_menu_version()))
+        drink_id = result.inserted_primary_key[0]
+        version = bump_menu_version(1)
+        return {'type': 'created', 'id': drink_id, 'version': version,
+                'drink': DrinkRecord(drink_id, title, recipe)}
+
+    @classmethod
+    def stage_update(cls, drink_id, title=None, recipe=None):
+        '''
+        Updates a drink in the current transaction without committing.
+
+        @INPUTS
+            drink_id: the id of the drink to update
+            title: the new title (or None to keep the current one)
+            recipe: the new recipe json string (or None to keep the current
+                one)
+
+        The row is stamped with the next menu version in the same statement,
+        so an id that is not in the database costs one statement and writes
+        nothing. A duplicate title raises an IntegrityError and the caller
+        must roll back.
+
+        Returns the change dict to pass to notify_menu_changed once the
+        transaction is committed, or None if there is no drink with that id.
+        '''
+        table = cls.__table__
+        values = {'version': next_menu_version()}
+        if title is not None:
+            values['title'] = title
+        if recipe is not None:
+            values['recipe'] = recipe
+        result = db.session.execute(
+            table.update().where(table.c.id == drink_id).values(**values))
+        if result.rowcount == 0:
+            return None
+        if title is None or recipe is None:
+            # the columns that were not submitted are read back before the
+            # commit, while the transaction still holds the write lock
+            row = db.session.execute(
+                select([table.c.title, table.c.recipe])
+                .where(table.c.id == drink_id)).first()
+            title, recipe = row
+        version = bump_menu_version()
+        return {'type': 'updated', 'id': drink_id, 'version': version,
+                'drink': DrinkRecord(drink_id, title, recipe)}
+
+    @classmethod
+    def stage_delete(cls, drink_id):
+        '''
+        Deletes a drink in the current transaction without committing.
+
+        @INPUTS
+            drink_id: the id of the drink to delete
+
+        Returns the change dict to pass to notify_menu_changed once the
+        transaction is committed, or None if there is no drink with that id.
+        '''
+        table = cls.__table__
+        result = db.session.execute(
+            table.delete().where(table.c.id == drink_id))
+        if result.rowcount == 0:
+            return None
+        version = bump_menu_version(-1)
+        db.session.execute(DrinkTombstone.__table__.insert().values(
+            drink_id=drink_id, version=version))
+        compact_tombstones()
+        return {'type': 'deleted', 'id': drink_id, 'version': version,
+                'drink': None}
+
+    @classmethod
+    def update_by_id(cls, drink_id, title=None, recipe=None):
+        '''
+        Updates a drink with a single UPDATE statement, without loading it.
+
+        @INPUTS
+            drink_id: the id of the drink to update
+            title: the new title (or None to keep the current one)
+            recipe: the new recipe json string (or None to keep the current
+                one)
+
+        A duplicate title raises an IntegrityError and the caller must roll
+        back.
+
+        Returns a DrinkRecord of the updated drink, or None if there is no
+        drink with that id.
+
+        EXAMPLE
+            record = Drink.update_by_id(id, title='Black Coffee')
+        '''
+        change = commit_write(
+            lambda: cls.stage_update(drink_id, title, recipe))
+        return change['drink'] if change is not None else None
+
+    @classmethod
+    def delete_by_id(cls, drink_id):
+        '''
+        Deletes a drink with a single DELETE statement, without loading it.
+
+        @INPUTS
+            drink_id: the id of the drink to delete
+
+        Returns True if the drink was deleted, or False if there is no drink
+        with that id.
+
+        EXAMPLE
+            if not Drink.delete_by_id(id):
+                abort(404)
+        '''
+        return commit_write(lambda: cls.stage_delete(drink_id)) is not None
 
+    def __repr__(self):
+        return json.dumps(self.short())
+
+
+class DrinkRecord:
+    '''
+    DrinkRecord - a read only drink for the list endpoints.
+
+    Built straight from a Core select of the id, title and recipe columns
+    (see load_drink_records) so reading the menu skips the ORM: there is no
+    instance state, no identity map entry and no per-attribute
+    instrumentation. short() and long() give the same representations as
+    the Drink model.
+    '''
+    __slots__ = ('id', 'title', 'recipe')
+
+    def __init__(self, id, title, recipe):
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'title', title)
+        object.__setattr__(self, 'recipe', recipe)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DrinkRecord is read only')
+
+    def short(self, cache=True):
+        '''
+        Short form representation of the drink
+
+        @INPUTS
+            cache: False to leave a parsed recipe out of the recipe cache
+        '''
+        return {
+            'id': self.id,
+            'title': self.title,
+            'recipe': recipe_cache.short(self.id, self.recipe, cache)
+        }
+
+    def long(self, cache=True):
+        '''
+        Long form representation of the drink
+
+        @INPUTS
+            cache: False to leave a parsed recipe out of the recipe cache
+        '''
+        return {
+            'id': self.id,
+            'title': self.title,
+            'recipe': recipe_cache.long(self.id, self.recipe, cache)
+        }
 
     def __repr__(self):
-        return json.dumps(self.short())
\ No newline at end of file
+        return json.dumps(self.short())
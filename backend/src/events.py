@@ -0,0 +1,210 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+# Get the logger specified in the file
+logger = logging.getLogger(__name__)
+
+
+class TooManySubscribersError(Exception):
+    '''
+    TooManySubscribersError Exception. Raised when the stream already has
+    the maximum number of subscribers.
+    '''
+    pass
+
+
+def format_event(event_id, name, data):
+    '''
+    Formats one Server-Sent Event.
+
+    @INPUTS
+        event_id: the event id (or None)
+        name: the event name
+        data: the event data, already encoded as json
+    '''
+    lines = []
+    if event_id is not None:
+        lines.append('id: ' + str(event_id))
+    lines.append('event: ' + name)
+    lines.append('data: ' + data)
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscriber:
+    '''
+    Subscriber - one connected client and its bounded event buffer.
+
+    A client that lets its buffer fill up is marked as overflowed and is
+    disconnected; it reconnects with Last-Event-ID and resumes from the
+    broker's history.
+    '''
+    __slots__ = ('events', 'buffer_size', 'overflowed')
+
+    def __init__(self, buffer_size):
+        self.events = deque()
+        self.buffer_size = buffer_size
+        self.overflowed = False
+
+    def push(self, event):
+        if len(self.events) >= self.buffer_size:
+            self.overflowed = True
+            return
+        self.events.append(event)
+
+
+class MenuEventBroker:
+    '''
+    MenuEventBroker - fans menu change events out to Server-Sent Event
+    streams.
+
+    Events are published by the Drink insert, update and delete methods of
+    this process (through models.menu_change_listeners). Each event gets an
+    id from a counter started from the clock, so ids keep increasing across
+    restarts, and the last history_size events are kept so a client that
+    reconnects with Last-Event-ID gets what it missed. A client whose
+    Last-Event-ID is older than the history, or was given by an earlier
+    run of the process, gets a 'reset' event telling it to reload the
+    menu.
+
+    An idle subscriber is a thread waiting on a condition variable that
+    only wakes for an event or a heartbeat, and the number of subscribers
+    is capped at max_subscribers.
+    '''
+    def __init__(self, max_subscribers=1000, buffer_size=100,
+                 history_size=1000):
+        self.max_subscribers = max_subscribers
+        self.buffer_size = buffer_size
+        self._history = deque(maxlen=history_size)
+        self._subscribers = set()
+        self._condition = threading.Condition()
+        self._next_id = int(time.time() * 1000)
+        # ids up to this one were not published by this broker
+        self._first_id = self._next_id
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def publish(self, name, data):
+        '''
+        Sends an event to every subscriber.
+
+        @INPUTS
+            name: the event name (i.e. 'drink.created')
+            data: a json serializable dict
+        '''
+        encoded = json.dumps(data, separators=(',', ':'), sort_keys=True)
+        with self._condition:
+            self._next_id += 1
+            event = (self._next_id, name, encoded)
+            self._history.append(event)
+            for subscriber in self._subscribers:
+                subscriber.push(event)
+            self._condition.notify_all()
+
+    def publish_change(self, change):
+        '''
+        Publishes a menu change, registered as a menu change listener.
+
+        @INPUTS
+            change: the change dict from models.notify_menu_changed
+        '''
+        if change is None:
+            self.publish('menu.reset', {})
+            return
+        drink = change['drink']
+        try:
+            short = drink.short() if drink is not None else None
+        except Exception as e:
+            # the write is already committed, tell clients to reload
+            logger.warning('Cannot publish drink %s, sending a reset: %r',
+                           change['id'], e)
+            self.publish('menu.reset', {})
+            return
+        self.publish('drink.' + change['type'], {
+            'id': change['id'],
+            'version': change['version'],
+            'drink': short
+        })
+
+    def subscribe(self, last_event_id=None):
+        '''
+        Adds a subscriber.
+
+        @INPUTS
+            last_event_id: the Last-Event-ID sent by a reconnecting client
+
+        Raises a TooManySubscribersError if the cap has been reached.
+
+        Returns the Subscriber, with any missed events already buffered.
+        '''
+        subscriber = Subscriber(self.buffer_size)
+        with self._condition:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise TooManySubscribersError()
+            if last_event_id is not None:
+                self._replay(subscriber, last_event_id)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def _replay(self, subscriber, last_event_id):
+        if last_event_id < self._first_id:
+            # the client was following an earlier run of the process
+            subscriber.push((None, 'menu.reset', '{}'))
+            return
+        if not self._history or last_event_id >= self._history[-1][0]:
+            return
+        if last_event_id < self._history[0][0] - 1:
+            # the events after last_event_id are no longer all known
+            subscriber.push((None, 'menu.reset', '{}'))
+            return
+        for event in self._history:
+            if event[0] > last_event_id:
+                subscriber.push(event)
+
+    def unsubscribe(self, subscriber):
+        with self._condition:
+            self._subscribers.discard(subscriber)
+
+    def wait(self, subscriber, timeout):
+        '''
+        Waits up to timeout seconds for events for a subscriber.
+
+        Returns the list of buffered events (empty on a timeout).
+        '''
+        with self._condition:
+            if not subscriber.events and not subscriber.overflowed:
+                self._condition.wait(timeout)
+            events = list(subscriber.events)
+            subscriber.events.clear()
+            return events
+
+    def stream(self, subscriber, heartbeat=15, retry=5000):
+        '''
+        Generates the Server-Sent Events text for a subscriber.
+
+        @INPUTS
+            subscriber: the Subscriber from subscribe()
+            heartbeat: seconds between comment lines sent to keep an idle
+                connection open
+            retry: the reconnect delay in milliseconds sent to the client
+
+        The subscriber is removed when the client disconnects or falls too
+        far behind.
+        '''
+        try:
+            yield 'retry: ' + str(retry) + '\n\n'
+            while True:
+                events = self.wait(subscriber, heartbeat)
+                for event in events:
+                    yield format_event(*event)
+                if subscriber.overflowed:
+                    logger.debug('Disconnecting a slow event subscriber')
+                    return
+                if not events:
+                    yield ': heartbeat\n\n'
+        finally:
+            self.unsubscribe(subscriber)
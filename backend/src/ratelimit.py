@@ -0,0 +1,217 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import request
+
+# Get the logger specified in the file
+logger = logging.getLogger(__name__)
+
+
+class RateLimitError(Exception):
+    '''
+    RateLimitError Exception. Raised when a client has used up its
+    request budget, retry_after is the number of seconds to wait.
+    '''
+    def __init__(self, retry_after):
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.status_code = 429
+        self.error = {
+            'code': 'rate_limited',
+            'description': 'Too many requests. Retry after ' +
+                           str(self.retry_after) + ' seconds.'
+        }
+
+
+def full_at(tokens, now, rate, burst):
+    '''
+    Returns the time a bucket holding tokens at now will be full again.
+    '''
+    return now + (burst - tokens) / rate
+
+
+def refill(tokens, updated, now, rate, burst):
+    '''
+    Takes one token from a token bucket.
+
+    @INPUTS
+        tokens: the tokens in the bucket when it was last updated
+        updated: the time the bucket was last updated
+        now: the current time
+        rate: the tokens added per second
+        burst: the size of the bucket
+
+    Returns a tuple of the new token count and the number of seconds to
+    wait (0 if a token was taken).
+    '''
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBucketStore:
+    '''
+    MemoryBucketStore - token buckets held in this process.
+
+    When there are more than max_keys buckets the ones that have had
+    time to refill completely are dropped, since a new bucket is full.
+    Each bucket keeps the time it will be full at its own rate and burst,
+    so limiters sharing the store do not drop each other's buckets early.
+    '''
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+            tokens, wait = refill(tokens, updated, now, rate, burst)
+            self._buckets[key] = (tokens, now,
+                                  full_at(tokens, now, rate, burst))
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                         if bucket[2] > now}
+
+
+class SqliteBucketStore:
+    '''
+    SqliteBucketStore - token buckets shared through a local SQLite file.
+
+    Used when several worker processes serve the API so that a client
+    gets one budget rather than one per worker. Each take is a single
+    short write transaction. As in MemoryBucketStore each bucket keeps
+    the time it will be full, which is what pruning goes by.
+    '''
+    def __init__(self, path, prune_every=1000):
+        self.path = path
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._takes = 0
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS rate_limit_buckets '
+                           '(key TEXT PRIMARY KEY, tokens REAL, updated REAL, '
+                           'full_at REAL)')
+        columns = [row[1] for row in connection.execute(
+            'PRAGMA table_info(rate_limit_buckets)')]
+        if 'full_at' not in columns:
+            # a file written before full_at was added
+            connection.execute('ALTER TABLE rate_limit_buckets '
+                               'ADD COLUMN full_at REAL DEFAULT 0')
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst):
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT tokens, updated FROM rate_limit_buckets '
+                'WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row is not None else (burst, now)
+            tokens, wait = refill(tokens, updated, now, rate, burst)
+            connection.execute(
+                'INSERT OR REPLACE INTO rate_limit_buckets '
+                '(key, tokens, updated, full_at) VALUES (?, ?, ?, ?)',
+                (key, tokens, now, full_at(tokens, now, rate, burst)))
+            self._takes += 1
+            if self._takes % self.prune_every == 0:
+                connection.execute(
+                    'DELETE FROM rate_limit_buckets WHERE full_at <= ?',
+                    (now,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class RateLimiter:
+    '''
+    RateLimiter - a token bucket per key (a JWT sub or a client IP).
+
+    Each key may make burst requests at once and then rate requests per
+    second. A rate of 0 disables the limiter.
+    '''
+    def __init__(self, name, rate, burst, store):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.store = store
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def check(self, key):
+        '''
+        Takes a token for the key.
+
+        Raises a RateLimitError if the key has no tokens left.
+        '''
+        wait = self.store.take(self.name + ':' + key, self.rate, self.burst)
+        if wait > 0:
+            logger.debug('Rate limited %s %s for %.2fs', self.name, key, wait)
+            raise RateLimitError(wait)
+
+
+def limit_by_subject(limiter):
+    '''
+    @limit_by_subject(limiter) decorator method.
+
+    Must be applied below @requires_auth. The JWT sub claim of the
+    payload passed to the decorated method is the rate limit key.
+    '''
+    def limit_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            if limiter.enabled:
+                limiter.check(str(payload.get('sub', request.remote_addr)))
+            return f(payload, *args, **kwargs)
+        return wrapper
+    return limit_decorator
+
+
+def limit_by_client(limiter):
+    '''
+    @limit_by_client(limiter) decorator method.
+
+    The client IP address is the rate limit key, for public endpoints.
+    '''
+    def limit_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if limiter.enabled:
+                limiter.check(str(request.remote_addr))
+            return f(*args, **kwargs)
+        return wrapper
+    return limit_decorator
+
+
+def bucket_store_from_env():
+    '''
+    Returns a SqliteBucketStore if RATE_LIMIT_DB is set (so that all
+    workers share the buckets), otherwise a MemoryBucketStore.
+    '''
+    path = os.getenv('RATE_LIMIT_DB')
+    if path:
+        return SqliteBucketStore(path)
+    return MemoryBucketStore()